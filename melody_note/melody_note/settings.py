@@ -141,4 +141,72 @@ ADMINS = [('hiveme', 'hiveme@163.com')]
 
 # EMAIL CONFIGURATION
 # -------------------------------------------------------------------------------
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
\ No newline at end of file
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# TRANSCRIPTION CONFIGURATION
+# -------------------------------------------------------------------------------
+# Resampler of the analysis stages: 'soxr' (librosa's resampler, the
+# fastest) or a polyphase profile 'fast', 'balanced' or 'high'
+# (see melody_note/work/wav_note/resample.py)
+RESAMPLE_QUALITY = 'soxr'
+
+# Number of web worker processes serving the site (gunicorn/uvicorn
+# --workers, WEB_CONCURRENCY). Every web process runs its own queue and
+# process pool, so the two totals below are split evenly between them
+WEB_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+# Transcription processes on this machine, over all web processes: each
+# web process gets a pool of TRANSCRIPTION_WORKERS // WEB_WORKERS (at
+# least one; see melody_note/tasks.py)
+TRANSCRIPTION_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Admission control: at most TRANSCRIPTION_MAX_PENDING jobs wait over all
+# web processes (more get 429 + Retry-After); waiting jobs run shortest
+# (estimated from the recording length) first, but one that has waited
+# longer than TRANSCRIPTION_MAX_WAIT seconds goes before any shorter one.
+# The cap, the order and Retry-After are per web process: a job only
+# competes with the jobs queued in the process that received it
+TRANSCRIPTION_MAX_PENDING = 20
+TRANSCRIPTION_MAX_WAIT = 30
+
+# Content-addressed cache of the transcription stage results (denoised
+# signal, onsets, detections, score), shared by the pool processes; the
+# least recently used entries go beyond STAGE_CACHE_MAX_BYTES
+# (see melody_note/work/wav_note/stage_cache.py)
+STAGE_CACHE_DIR = BASE_DIR / 'melody_note' / 'work' / 'stage_cache'
+STAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# LilyPond output (.pdf/.mid) by digest of the .ly text and LilyPond
+# version, so an identical score is never engraved twice; evicted by total
+# size (see melody_note/work/wav_note/render_cache.py)
+RENDER_CACHE_DIR = BASE_DIR / 'melody_note' / 'work' / 'render_cache'
+RENDER_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# The pool processes of all web processes hand their scores to one
+# engraving service, listening on ENGRAVE_ADDRESS (started by the first web
+# process that dispatches a job), which engraves the scores submitted
+# within ENGRAVE_WINDOW seconds in a single LilyPond run. A batch holds at
+# most ENGRAVE_BATCH_SIZE scores, and never more than TRANSCRIPTION_WORKERS
+# since each pool process waits for its own score; a batch size of 1 makes
+# every process run LilyPond itself (see melody_note/work/wav_note/engraver.py)
+ENGRAVE_ADDRESS = ('127.0.0.1', int(os.environ.get('ENGRAVE_PORT', 50765)))
+ENGRAVE_WINDOW = 0.2
+ENGRAVE_BATCH_SIZE = 16
+
+# CACHE CONFIGURATION
+# -------------------------------------------------------------------------------
+# 'jobs' holds the per-session jobs (melody_note/work/jobs.py). It must be
+# shared by all worker processes, so it is file based rather than in memory.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'jobs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'jobs'),
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
\ No newline at end of file
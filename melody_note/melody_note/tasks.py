@@ -0,0 +1,445 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import itertools
+import json
+import math
+from multiprocessing.managers import BaseManager
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import django
+from django.conf import settings
+from django.core.cache import caches
+from melody_note.work import jobs
+from melody_note.work.wav_note.wav_reader import read_header
+from melody_note.work.wav_note.stage_cache import StageCache
+from melody_note.work.wav_note.render_cache import RenderCache
+from melody_note.work.wav_note.engraver import BatchEngraver
+
+# 转换耗时估计（秒）：LilyPond 与 MIDI 的固定开销 + 录音采样数 / 每秒处理的采样数
+BASE_COST = 1.0
+SAMPLES_PER_SECOND = 2.5e6
+
+
+def job_store():
+    return jobs.JobStore(caches['jobs'])
+
+
+# 本进程的阶段缓存与 LilyPond 输出缓存，首次使用时创建
+_stage_cache = None
+_render_cache = None
+# 本进程的命中/未命中次数文件（<STAGE_CACHE_DIR>/stats/<随机名>.json），首次保存时确定
+_stats_file = None
+
+
+def stage_cache():
+    global _stage_cache
+    if _stage_cache is None:
+        _stage_cache = StageCache(str(settings.STAGE_CACHE_DIR), settings.STAGE_CACHE_MAX_BYTES)
+    return _stage_cache
+
+
+def render_cache():
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = RenderCache(str(settings.RENDER_CACHE_DIR), settings.RENDER_CACHE_MAX_BYTES)
+    return _render_cache
+
+
+def local_cache_stats():
+    # 本进程两个缓存的命中/未命中次数，StageCache.stats() 的格式
+    stats = stage_cache().stats()
+    for kind, counts in render_cache().stats().items():
+        stats[kind].update(counts)
+    return stats
+
+
+def stats_directory():
+    return os.path.join(str(settings.STAGE_CACHE_DIR), 'stats')
+
+
+def save_cache_stats():
+    """
+        Writes the hits and misses counted by this process so far to its
+        own file in stats_directory(). Every process only replaces its own
+        file, so no update is lost; cache_stats() sums the files.
+    """
+
+    global _stats_file
+    if _stage_cache is None and _render_cache is None:
+        return
+    directory = stats_directory()
+    os.makedirs(directory, exist_ok=True)
+    if _stats_file is None:
+        _stats_file = os.path.join(directory, uuid.uuid4().hex + '.json')
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.stats')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(local_cache_stats(), f)
+        os.replace(tmp, _stats_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def cache_stats():
+    """
+        Stage cache and render cache hits and misses of all processes,
+        by stage.
+    """
+
+    save_cache_stats()
+    stages = StageCache.STAGES + (RenderCache.STAGE,)
+    totals = dict((kind, dict((stage, 0) for stage in stages)) for kind in ('hits', 'misses'))
+    directory = stats_directory()
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for kind, counts in stats.items():
+            for stage, count in counts.items():
+                totals[kind][stage] = totals[kind].get(stage, 0) + count
+    return totals
+
+
+def init_worker():
+    """
+        Sets Django up in a pool process. Forked processes inherit the
+        configured settings; spawned ones (Windows) start from scratch.
+    """
+
+    global _stage_cache, _render_cache, _stats_file
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'melody_note.settings')
+    django.setup()
+    # fork 时继承的缓存对象带有父进程的计数，本进程重新计数并使用自己的文件
+    _stage_cache = _render_cache = _stats_file = None
+
+
+def estimate_cost(wav_file):
+    """
+        Estimated transcription time (s) of a recording, from its wav
+        header: processing cost grows with the number of samples, i.e. with
+        duration, sample rate and channels.
+    """
+
+    try:
+        with open(wav_file, 'rb') as f:
+            params, offset, data_size = read_header(f)
+    except (OSError, ValueError):
+        return BASE_COST
+    return BASE_COST + params.nframes * params.nchannels / SAMPLES_PER_SECOND
+
+
+class Saturated(Exception):
+    """
+        The scheduler's queue is full; retry_after is the estimated wait
+        (s) until it has room again.
+    """
+
+    def __init__(self, retry_after):
+        super(Saturated, self).__init__('transcription queue is full')
+        self.retry_after = retry_after
+
+
+class EngraverManager(BaseManager):
+    """
+        Serves the machine's one BatchEngraver at settings.ENGRAVE_ADDRESS
+        from a process of its own; the pool processes of every web process
+        call it through a proxy, each call in a thread of the manager, so
+        their scores meet in the same batches.
+    """
+
+
+# 打谱服务进程中唯一的 BatchEngraver，由 init_engraver 创建
+_batch_engraver = None
+
+
+def init_engraver(window, max_batch):
+    global _batch_engraver
+    _batch_engraver = BatchEngraver(window=window, max_batch=max_batch)
+
+
+def batch_engraver():
+    return _batch_engraver
+
+
+EngraverManager.register('engraver', batch_engraver, exposed=('engrave', 'stats'))
+
+
+def engraver_manager():
+    # 用 SECRET_KEY 派生连接密钥，只有本站点的进程能连接打谱服务
+    authkey = hashlib.sha256(('engraver:' + settings.SECRET_KEY).encode('utf-8')).digest()
+    return EngraverManager(tuple(settings.ENGRAVE_ADDRESS), authkey)
+
+
+def engrave_batch_size():
+    """
+        Largest batch worth waiting for: every pool process of the machine
+        has at most one score in flight, so a batch never holds more than
+        TRANSCRIPTION_WORKERS scores.
+    """
+
+    return min(settings.ENGRAVE_BATCH_SIZE, settings.TRANSCRIPTION_WORKERS)
+
+
+def engraver():
+    """
+        Proxy of the shared engraving service, None when scores are not
+        batched or the service is not running (the score is then engraved
+        by this process).
+    """
+
+    if engrave_batch_size() <= 1:
+        return None
+    manager = engraver_manager()
+    try:
+        manager.connect()
+        return manager.engraver()
+    except (OSError, EOFError) as e:
+        print ('Engraving service unavailable: ' + str(e))
+        return None
+
+
+# 本进程启动的打谱服务（其他 web 进程已启动时为 None）
+_engraver_server = None
+_engraver_lock = threading.Lock()
+
+
+def start_engraver():
+    """
+        Makes sure the shared engraving service is running, starting it from
+        this process if nothing serves settings.ENGRAVE_ADDRESS yet. When
+        several web processes race, the ones that cannot bind the address
+        use the winner's service. Called once, when the Scheduler's
+        dispatcher starts.
+    """
+
+    global _engraver_server
+    if engrave_batch_size() <= 1:
+        return
+    with _engraver_lock:
+        try:
+            engraver_manager().connect()
+            return
+        except OSError:
+            pass
+        server = engraver_manager()
+        try:
+            server.start(init_engraver, (settings.ENGRAVE_WINDOW, engrave_batch_size()))
+        except (OSError, EOFError) as e:
+            # 地址已被占用：其他 web 进程刚启动了服务
+            print ('Engraving service not started: ' + str(e))
+            return
+        _engraver_server = server
+
+
+class Scheduler(object):
+    """
+        Admission control and shortest-job-first dispatch of transcriptions
+        onto a process pool. At most max_pending jobs wait; further ones are
+        refused with an estimate of when to retry. A free worker takes the
+        pending job with the lowest estimated cost, unless a job has waited
+        longer than max_wait seconds: those go first, oldest first, so long
+        recordings are delayed but never starved.
+    """
+
+    def __init__(self, workers, max_pending, max_wait):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        # (estimated cost, enqueue time, sequence number, run_job arguments)
+        self.pending = []
+        # 正在运行的任务的估计耗时
+        self.running = {}
+        # 排队或运行中的任务 ID，同一任务不重复提交
+        self.active = set()
+        self.sequence = itertools.count()
+        self.executor = None
+        self.dispatcher = None
+
+    def retry_after(self):
+        """
+            Seconds until the work ahead of a new job is estimated to be
+            done, spread over the workers.
+        """
+
+        work = sum(self.running.values()) + sum(item[0] for item in self.pending)
+        return max(1, int(math.ceil(work / self.workers)))
+
+    def submit(self, cost, *args, admitted=None):
+        """
+            Queues run_job(*args) with the given estimated cost and returns
+            True; returns False if the job (args[0]) is already pending or
+            running here. Raises Saturated when max_pending jobs are already
+            waiting. admitted(), if given, is called once the job is
+            accepted and before it can be dispatched; if it returns False
+            or raises, the job is not queued.
+        """
+
+        job_id = args[0]
+        with self.condition:
+            if job_id in self.active:
+                return False
+            if len(self.pending) >= self.max_pending:
+                raise Saturated(self.retry_after())
+            if admitted is not None and not admitted():
+                return False
+            self.active.add(job_id)
+            self.pending.append((cost, time.time(), next(self.sequence), args))
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+                self.dispatcher.start()
+            self.condition.notify()
+        return True
+
+    def next_job(self):
+        now = time.time()
+        starved = [item for item in self.pending if now - item[1] > self.max_wait]
+        if starved:
+            item = min(starved, key=lambda item: item[1])
+        else:
+            item = min(self.pending, key=lambda item: (item[0], item[2]))
+        self.pending.remove(item)
+        return item
+
+    def dispatch(self):
+        # 每个进程只检查/启动一次打谱服务；失败不影响转换，engraver() 会退回到本进程运行 LilyPond
+        try:
+            start_engraver()
+        except Exception:
+            traceback.print_exc()
+        while True:
+            with self.condition:
+                while not self.pending or len(self.running) >= self.workers:
+                    self.condition.wait()
+                cost, enqueued, sequence, args = self.next_job()
+                self.running[sequence] = cost
+            try:
+                future = self.start(args)
+            except Exception as e:
+                # 提交失败（如进程池无法重建）：任务记为失败，释放名额，继续调度
+                self.release(sequence, args[0])
+                mark_failed(job_store(), args[0], str(e))
+                continue
+            future.add_done_callback(lambda future, sequence=sequence, job_id=args[0]:
+                                     self.done(sequence, job_id, future))
+
+    def start(self, args):
+        try:
+            return self.pool().submit(run_job, *args)
+        except BrokenProcessPool:
+            # 某个进程异常退出后进程池不可用，重建一次
+            self.executor = None
+            return self.pool().submit(run_job, *args)
+
+    def release(self, sequence, job_id):
+        with self.condition:
+            del self.running[sequence]
+            self.active.discard(job_id)
+            self.condition.notify()
+
+    def done(self, sequence, job_id, future):
+        self.release(sequence, job_id)
+        if future.exception() is not None:
+            # 进程异常退出，run_job 没能记录失败
+            mark_failed(job_store(), job_id, str(future.exception()))
+
+    def pool(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_worker)
+        return self.executor
+
+
+# 每个 web 进程一个调度器，首次提交时创建
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def scheduler():
+    """
+        The Scheduler of this web process. TRANSCRIPTION_WORKERS and
+        TRANSCRIPTION_MAX_PENDING are totals for the machine, split evenly
+        between the WEB_WORKERS web processes so that their pools together
+        do not oversubscribe the CPUs.
+    """
+
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            web_workers = settings.WEB_WORKERS
+            workers = max(1, settings.TRANSCRIPTION_WORKERS // web_workers)
+            max_pending = max(1, int(math.ceil(settings.TRANSCRIPTION_MAX_PENDING / web_workers)))
+            _scheduler = Scheduler(workers, max_pending, settings.TRANSCRIPTION_MAX_WAIT)
+        return _scheduler
+
+
+def enqueue(store, job, program=0):
+    """
+        Queues the transcription and composition of a recorded job and
+        returns at once; the job's status and stage in the store report its
+        progress. Returns False if the job is already queued or running
+        (e.g. a repeated request). Raises Saturated if the queue is full.
+    """
+
+    def admitted():
+        # 在调度器的锁内重新读取任务状态：重复的请求不再提交
+        current = store.get(job.id)
+        if current is not None and current.status in (jobs.QUEUED, jobs.RUNNING):
+            return False
+        # 先确认有排队名额再保存 QUEUED，被拒绝的任务保持原状态
+        job.status = jobs.QUEUED
+        job.stage = None
+        job.error = None
+        store.save(job)
+        return True
+
+    return scheduler().submit(estimate_cost(job.wav_file), job.id, settings.RESAMPLE_QUALITY, program,
+                              admitted=admitted)
+
+
+def mark_failed(store, job_id, error):
+    job = store.get(job_id)
+    if job is not None:
+        job.status = jobs.FAILED
+        job.error = error
+        store.save(job)
+
+
+def run_job(job_id, resample_quality, program):
+    """
+        Runs in a pool process: recording -> notes and score -> instrument
+        MIDI, saving the stage reached to the job store as it goes. The
+        score is engraved by the shared engraving service when it is up.
+    """
+
+    store = job_store()
+    job = store.get(job_id)
+    if job is None:
+        return
+
+    def progress(stage):
+        job.stage = stage
+        store.save(job)
+
+    job.status = jobs.RUNNING
+    store.save(job)
+    try:
+        melody = jobs.get_notes(job, resample_quality, progress, stage_cache(), render_cache(), engraver())
+        progress('compose')
+        jobs.choose_program(store, job, program)
+        jobs.create_melody(store, job, melody)
+    except Exception as e:
+        traceback.print_exc()
+        mark_failed(store, job_id, str(e))
+    finally:
+        save_cache_stats()
@@ -24,7 +24,6 @@ urlpatterns = [
     path('melody_note/', views.melody_note),
     path('homepage/', views.homepage),
     path('index/', views.index),
-    path('get_notes/', views.get_notes),
     path('test/',views.test),
     path('print/', views.dayin),
     path('set_name/' ,views.setname),
@@ -32,6 +31,10 @@ urlpatterns = [
     path('stop_record/', views.stoprecord),
     path('get_music/', views.getmusic),
     path('play_music/', views.playmusic),
+    path('job_status/', views.jobstatus),
+    path('job_events/', views.jobevents),
+    path('download/', views.download),
+    path('cache_stats/', views.cachestats),
 ]
 
 
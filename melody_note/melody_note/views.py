@@ -1,152 +1,336 @@
 from binstar_client.pprintb import user_list
 from django.shortcuts import render,redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.db import connections
 from django.http import HttpResponseRedirect
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import asyncio
+import functools
 import json
 import time
 import os
-from melody_note.work.sound_recorder import record
-from melody_note.work.wav_note import music_transcriber
-from melody_note.work.compose import music
+import re
+from melody_note.work import jobs
+from melody_note import tasks
 
-# 全局变量
 BASE_DIR = os.getcwd()
-music_name = 'default'      # 音乐名
-rec = record.Recorder()     # 录音
-rec.set_name(music_name)
-composer = music.Music()    # 音符转乐器
 begin = time.time()
 final = begin
 
+# 任务（录音、路径、乐器）按 /set_name/ 返回的 ID 保存在所有 worker 进程共享的缓存中
+job_store = jobs.JobStore(caches['jobs'])
 
+# 结果文件的 MIME 类型
+ARTIFACT_TYPES = {'pdf': 'application/pdf', 'mid': 'audio/midi', 'wav': 'audio/wav'}
 
-# 设置音乐名（不需要带.wav或.mid等后缀）
-def set_music_name(name):
-    global music_name
-    global rec
-    global composer
-    music_name = name
-    print("set:"+music_name)
-    rec.set_name(music_name)
-    composer.set_name(music_name)
+# 服务器推送事件：检查任务状态的间隔与连接的最长时间（秒）
+EVENTS_POLL_INTERVAL = 0.5
+EVENTS_TIMEOUT = 600
 
+# 任务不再变化的状态
+FINISHED = (jobs.COMPOSED, jobs.FAILED)
 
-# 开始录音
-def start_record():
-    rec.start()
+# /job_status/?wait= 长轮询的最长等待时间（秒）
+STATUS_MAX_WAIT = 60
 
+# 下载时每次读取的字节数；只支持单个范围的 Range 请求
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
 
-# 结束录音并将wav文件保存在record_wav文件夹
-def stop_record():
-    rec.stop()
-    print("stop:"+music_name)
-    rec.save(os.path.join(BASE_DIR, 'melody_note','work','record_wav', music_name + '.wav'))
 
-
-# 提取音符并将乐谱pdf保存在note_pdf文件夹下
-def get_notes(file_name=None):
-    if file_name == None:
-        file_name = os.path.join(BASE_DIR,'melody_note','work', 'record_wav', music_name + '.wav')
-    transcriber = music_transcriber.MusicTranscriber(file_name)
-    notes, durations = transcriber.transcribe()
-    durations = [i * 2 for i in durations]
-    melody = [tuple(i) for i in zip(notes, durations)]
-    return melody
+def json_response(data, status=200):
+    response = HttpResponse(json.dumps(data), content_type="application/json", status=status)
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
+    response["Access-Control-Max-Age"] = "1000"
+    response["Access-Control-Allow-Headers"] = "*"
+    return response
 
 
-# 设置乐器：https://blog.csdn.net/ruyulin/article/details/84103186
-def choose_program(program=0):
-    composer.set_program(program)
+async def run_sync(func, *args):
+    """
+        Runs a blocking call (job store, files, recorder, transcription) on
+        a worker thread, so that waiting for it does not hold the event loop.
+    """
 
+    return await sync_to_async(func, thread_sensitive=False)(*args)
 
-# 音符转乐器音并将mid文件保存在compose_mid文件夹下
-def create_melody(melody):
-    composer.set_melody(melody)
 
+def under_asgi(request):
+    """
+        Whether the request is served by an ASGI server. Django sends async
+        iterators chunk by chunk only under ASGI; under WSGI (runserver) it
+        collects them into a list first, so streams must be sync there.
+    """
 
-# 播放保存的mid文件
-def play_music():
-    if os.path.exists(os.path.join(composer.save_path, composer.name + '.mid')):
-        composer.play_midi()
+    return isinstance(request, ASGIRequest)
 
 
-# mid转wav
-def mid2wav():
-    if os.path.exists(os.path.join(composer.save_path, composer.name + '.mid')):
-        composer.transfer_wav()
+def job_view(view):
+    """
+        Passes the job named by the `job` parameter to the (async) view;
+        answers 404 if there is no such job.
+    """
 
+    @functools.wraps(view)
+    async def wrapper(request):
+        job = await run_sync(job_store.get, request.GET.get("job"))
+        if job is None:
+            return json_response({"status": 0, "error": "unknown job"}, status=404)
+        return await view(request, job)
+    return wrapper
 
 
+async def wait_for_job(job, done, timeout, interval=EVENTS_POLL_INTERVAL):
+    """
+        Reloads the job every interval seconds until done(job) holds or
+        timeout seconds have passed and returns the last version. The
+        request sleeps on the event loop in between instead of holding a
+        thread.
+    """
 
+    deadline = time.time() + timeout
+    while not done(job) and time.time() < deadline:
+        await asyncio.sleep(interval)
+        job = await run_sync(job_store.get, job.id) or job
+    return job
 
 
-def setname(request):
-    # step 1. 设置乐曲名
+async def setname(request):
+    # step 1. 设置乐曲名，创建任务
     if(request.GET.get("title")):
         title = request.GET.get("title")
     else:
         title = "tmp"
-    set_music_name(title)
-    print("set:"+title)
-    response = HttpResponse(json.dumps({"status": 1}), content_type="application/json")
-    response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "1000"
-    response["Access-Control-Allow-Headers"] = "*"
-    return response
+    job = await run_sync(job_store.create, title)
+    print("set:" + title + " job:" + job.id)
+    return json_response({"status": 1, "job": job.id})
 
-def startrecord(request):
+
+@job_view
+async def startrecord(request, job):
     # step 2. 开始录制
-    start_record()
-    print("start:"+music_name)
-    print("1:"+os.path.abspath(os.path.dirname(__file__)))
-    print("2:"+os.path.dirname(__file__))
-    response = HttpResponse(json.dumps({"status": 1}), content_type="application/json")
+    await run_sync(jobs.start_record, job_store, job)
+    print("start:" + job.name)
+    return json_response({"status": 1})
+
+
+@job_view
+async def stoprecord(request, job):
+    # step 3. 结束录制，等待录音所在的进程保存 wav 文件
+    await run_sync(jobs.request_stop, job_store, job)
+    job = await wait_for_job(job, lambda current: current.status != jobs.STOPPING, jobs.STOP_TIMEOUT,
+                             jobs.POLL_INTERVAL)
+    if job.status != jobs.RECORDED:
+        return json_response({"status": 0, "error": "recording not saved"}, status=409)
+    print("stop:" + job.name)
+    return json_response({"status": 1})
+
+
+@job_view
+async def getmusic(request, job):
+    # step 4、5. 音频转乐谱音符、音符转乐器曲，交给转换进程池后立即返回，
+    # 进度见 /job_status/ 或 /job_events/
+    if job.status in (jobs.QUEUED, jobs.RUNNING):
+        return json_response({"status": 1, "job": job.id})
+    if job.status not in (jobs.RECORDED, jobs.COMPOSED, jobs.FAILED):
+        return json_response({"status": 0, "error": "nothing recorded"}, status=409)
+    try:
+        await run_sync(tasks.enqueue, job_store, job, 0)  # 可以设置乐器
+    except tasks.Saturated as e:
+        response = json_response({"status": 0, "error": str(e), "retry_after": e.retry_after}, status=429)
+        response["Retry-After"] = str(e.retry_after)
+        return response
+    return json_response({"status": 1, "job": job.id})
+
+
+def job_state(job):
+    """
+        What /job_status/ and /job_events/ report about a job.
+    """
+
+    artifacts = dict((kind, "/download/?job=%s&kind=%s" % (job.id, kind)) for kind in job.artifacts())
+    return {"job": job.id, "state": job.status, "stage": job.stage, "error": job.error,
+            "artifacts": artifacts}
+
+
+@job_view
+async def jobstatus(request, job):
+    # 长轮询：带 wait=秒数 时，等到任务的 state/stage 与请求中给出的（默认为当前的）不同、
+    # 任务结束或超时后才返回
+    try:
+        wait = min(max(float(request.GET.get("wait") or 0), 0), STATUS_MAX_WAIT)
+    except ValueError:
+        return json_response({"status": 0, "error": "invalid wait"}, status=400)
+    seen = (request.GET.get("state", job.status), request.GET.get("stage", job.stage or ""))
+
+    def changed(current):
+        return current.status in FINISHED or (current.status, current.stage or "") != seen
+
+    job = await wait_for_job(job, changed, wait)
+    state = await run_sync(job_state, job)
+    state["status"] = 1
+    return json_response(state)
+
+
+@job_view
+async def jobevents(request, job):
+    # 每当任务状态变化时推送一次，任务完成或失败后结束
+    async def events():
+        last = None
+        deadline = time.time() + EVENTS_TIMEOUT
+        current = job
+        while current is not None and time.time() < deadline:
+            state = await run_sync(job_state, current)
+            if state != last:
+                yield "data: %s\n\n" % (json.dumps(state),)
+                last = state
+            if current.status in FINISHED:
+                break
+            await asyncio.sleep(EVENTS_POLL_INTERVAL)
+            current = await run_sync(job_store.get, job.id)
+
+    # WSGI 下的同一事件流（每个连接占用一个线程）
+    def sync_events():
+        last = None
+        deadline = time.time() + EVENTS_TIMEOUT
+        current = job
+        while current is not None and time.time() < deadline:
+            state = job_state(current)
+            if state != last:
+                yield "data: %s\n\n" % (json.dumps(state),)
+                last = state
+            if current.status in FINISHED:
+                break
+            time.sleep(EVENTS_POLL_INTERVAL)
+            current = job_store.get(job.id)
+
+    response = StreamingHttpResponse(events() if under_asgi(request) else sync_events(),
+                                     content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
     response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "1000"
-    response["Access-Control-Allow-Headers"] = "*"
     return response
 
 
-def stoprecord(request):
-    # step 3. 结束录制
-    stop_record()
-    print("stop:" + music_name)
-
-    response = HttpResponse(json.dumps({"status": 1}), content_type="application/json")
+def requested_range(request, etag, mtime, size):
+    """
+        The (first, last) byte positions asked for by the Range header.
+        None means the whole file: no Range header, one Django does not
+        serve (malformed, several ranges) or an If-Range validator that no
+        longer matches the file. False means the range starts past the end
+        of the file.
+    """
+
+    header = request.META.get("HTTP_RANGE")
+    if not header:
+        return None
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range:
+        date = parse_http_date_safe(if_range)
+        if (date is None and if_range != etag) or (date is not None and int(mtime) > date):
+            return None
+    match = RANGE_RE.match(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # bytes=-N：最后 N 个字节
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size:
+        return False
+    if first > last:
+        return None
+    return first, last
+
+
+def sync_file_chunks(path, first, last):
+    # file_chunks 的同步版本，用于 WSGI
+    with open(path, 'rb') as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def file_chunks(path, first, last):
+    # 读取文件的 [first, last] 字节，每次 DOWNLOAD_CHUNK_SIZE 字节，读文件在线程中进行
+    f = await run_sync(open, path, 'rb')
+    try:
+        await run_sync(f.seek, first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = await run_sync(f.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+@job_view
+async def download(request, job):
+    # 下载结果文件：ETag/Last-Modified 相同时返回 304，支持 Range（断点续传、音频拖动）
+    kind = request.GET.get("kind")
+    path = (await run_sync(job.artifacts)).get(kind)
+    try:
+        stat = await run_sync(os.stat, path) if path is not None else None
+    except FileNotFoundError:
+        stat = None
+    if stat is None:
+        return json_response({"status": 0, "error": "no such artifact"}, status=404)
+
+    # 重新转换会改写文件，修改时间与大小一起作为 ETag
+    etag = quote_etag("%x-%x" % (stat.st_mtime_ns, stat.st_size))
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        byte_range = requested_range(request, etag, stat.st_mtime, stat.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % (stat.st_size,)
+        else:
+            first, last = byte_range or (0, stat.st_size - 1)
+            chunks = file_chunks if under_asgi(request) else sync_file_chunks
+            response = StreamingHttpResponse(chunks(path, first, last), status=206 if byte_range else 200,
+                                             content_type=ARTIFACT_TYPES[kind])
+            response["Content-Length"] = str(last - first + 1)
+            if byte_range:
+                response["Content-Range"] = "bytes %d-%d/%d" % (first, last, stat.st_size)
+            response["Content-Disposition"] = content_disposition_header(True, job.download_name(kind))
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    response["Accept-Ranges"] = "bytes"
+    response["Cache-Control"] = "private, no-cache"
     response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "1000"
-    response["Access-Control-Allow-Headers"] = "*"
+    response["Access-Control-Expose-Headers"] = "ETag, Last-Modified, Content-Range, Content-Disposition"
     return response
 
 
-def getmusic(request):
-    # step 4. 音频转乐谱音符
-    melody = get_notes()
+async def cachestats(request):
+    # 阶段缓存（stage_cache.py）各阶段与 LilyPond 输出缓存（render_cache.py）的命中与未命中次数
+    stats = await run_sync(tasks.cache_stats)
+    stats["status"] = 1
+    return json_response(stats)
 
-    # step 5. 音符转乐器曲
-    choose_program(0)  # 可以设置乐器
-    create_melody(melody)
-
-    response = HttpResponse(json.dumps({"status": 1}), content_type="application/json")
-    response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "1000"
-    response["Access-Control-Allow-Headers"] = "*"
-    return response
 
+@job_view
+async def playmusic(request, job):
+    # 播放期间一直阻塞，放在线程中执行
+    await run_sync(jobs.play_music, job)
+    return json_response({"status": 1})
 
-def playmusic(request):
-    play_music()
-    response = HttpResponse(json.dumps({"status": 1}), content_type="application/json")
-    response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "1000"
-    response["Access-Control-Allow-Headers"] = "*"
-    return response
 
 def melody_note(request):
     return render(request, 'melody_note.html')
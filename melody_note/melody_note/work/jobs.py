@@ -0,0 +1,274 @@
+import os
+import re
+import threading
+import time
+import uuid
+from .sound_recorder import record
+from .wav_note import music_transcriber
+from .wav_note.resample import DEFAULT_QUALITY
+from .compose import music
+
+WORK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 任务状态
+CREATED = 'created'
+RECORDING = 'recording'
+STOPPING = 'stopping'       # 已请求结束录音，等待录音所在的进程保存 wav 文件
+RECORDED = 'recorded'
+QUEUED = 'queued'           # 等待转换进程池处理
+RUNNING = 'running'         # 转换中，当前阶段见 Job.stage
+COMPOSED = 'composed'
+FAILED = 'failed'
+
+# 任务文件的固定文件名：乐曲名只作为显示用的元数据，不出现在路径中
+FILE_NAME = 'melody'
+
+# 录音线程检查结束请求的间隔（秒），stop_record 等待 wav 文件保存的最长时间（秒）
+POLL_INTERVAL = 0.1
+STOP_TIMEOUT = 10.0
+
+
+class Job(object):
+    """
+        One user's session: the music name, the instrument program, the
+        state of the recording and the files they produce. A job is plain
+        data, so any worker process can load it from a JobStore. Its files
+        have fixed names (FILE_NAME) in directories named after the job ID:
+        the music name is user input and only labels downloads
+        (download_name).
+    """
+
+    def __init__(self, name='default', job_id=None, program=0, status=CREATED, stage=None, error=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.program = program
+        self.status = status
+        # 转换的当前阶段（music_transcriber.STAGES 或 'compose'）与失败原因
+        self.stage = stage
+        self.error = error
+
+    @property
+    def wav_file(self):
+        # 录音：record_wav/<id>/melody.wav
+        return os.path.join(WORK_DIR, 'record_wav', self.id, FILE_NAME + '.wav')
+
+    @property
+    def pdf_dir(self):
+        # 乐谱：note_pdf/<id>/melody.pdf（MusicTranscriber 按录音文件名命名）
+        return os.path.join(WORK_DIR, 'note_pdf', self.id)
+
+    @property
+    def pdf_file(self):
+        return os.path.join(self.pdf_dir, FILE_NAME + '.pdf')
+
+    @property
+    def mid_dir(self):
+        # 乐器曲：compose_mid/<id>/melody.mid
+        return os.path.join(WORK_DIR, 'compose_mid', self.id)
+
+    @property
+    def mid_file(self):
+        return os.path.join(self.mid_dir, FILE_NAME + '.mid')
+
+    @property
+    def synth_file(self):
+        # mid2wav 的输出
+        return os.path.join(self.mid_dir, FILE_NAME + '.wav')
+
+    def artifacts(self):
+        """
+            The result files of the job that exist so far, by kind
+            ('pdf', 'mid', 'wav').
+        """
+
+        files = {'pdf': self.pdf_file, 'mid': self.mid_file, 'wav': self.synth_file}
+        return dict((kind, path) for kind, path in files.items() if os.path.exists(path))
+
+    def download_name(self, kind):
+        """
+            File name a result is downloaded as: the music name, with the
+            characters file systems reject replaced, and the kind as
+            extension.
+        """
+
+        name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', self.name).strip(' .') or FILE_NAME
+        return name + '.' + kind
+
+    def composer(self, melody=None):
+        """
+            The job's music.Music; with a melody the .mid file is written.
+        """
+
+        os.makedirs(self.mid_dir, exist_ok=True)
+        return music.Music(melody, name=FILE_NAME, program=self.program, save_path=self.mid_dir)
+
+    def to_dict(self):
+        return {'job_id': self.id, 'name': self.name, 'program': self.program, 'status': self.status,
+                'stage': self.stage, 'error': self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class MemoryCache(object):
+    """
+        A dict with the get/set of a Django cache, for a JobStore used by a
+        single process without Django (handle.py). Entries never expire.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+
+class JobStore(object):
+    """
+        Jobs kept in a cache: any object with the get(key) and set(key,
+        value) of a Django cache backend. With a backend shared by all
+        worker processes (settings.CACHES['jobs']) the requests of one
+        session can be served by any worker and thread; MemoryCache keeps
+        them in the current process.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    @staticmethod
+    def key(job_id):
+        return 'job:%s' % (job_id,)
+
+    def create(self, name):
+        job = Job(name)
+        os.makedirs(os.path.dirname(job.wav_file), exist_ok=True)
+        self.save(job)
+        return job
+
+    def get(self, job_id):
+        """
+            Returns the job with the given ID, None if it does not exist
+            (or has expired).
+        """
+
+        if not job_id:
+            return None
+        data = self.cache.get(self.key(job_id))
+        if data is None:
+            return None
+        return Job.from_dict(data)
+
+    def save(self, job):
+        self.cache.set(self.key(job.id), job.to_dict())
+
+
+# 本进程中正在录音的 Recorder，按任务 ID 索引
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def start_record(store, job):
+    """
+        Starts recording in this process. The recording stops when any
+        process marks the job as no longer recording (stop_record); this
+        process then saves the wav file.
+    """
+
+    if job.status in (RECORDING, STOPPING):
+        return
+    rec = record.Recorder()
+    rec.set_name(FILE_NAME)
+    with _recorders_lock:
+        if job.id in _recorders:
+            return
+        _recorders[job.id] = rec
+    job.status = RECORDING
+    store.save(job)
+    rec.start()
+    threading.Thread(target=_watch_recording, args=(store, job.id, rec), daemon=True).start()
+
+
+def _watch_recording(store, job_id, rec):
+    job = store.get(job_id)
+    while job is not None and job.status == RECORDING:
+        time.sleep(POLL_INTERVAL)
+        job = store.get(job_id)
+    rec.stop()
+    with _recorders_lock:
+        del _recorders[job_id]
+    if job is not None:
+        rec.save(job.wav_file)
+        job.status = RECORDED
+        store.save(job)
+
+
+def request_stop(store, job):
+    """
+        Asks the process that records the job to stop; it saves the wav
+        file and marks the job RECORDED.
+    """
+
+    if job.status == RECORDING:
+        job.status = STOPPING
+        store.save(job)
+
+
+def stop_record(store, job, timeout=STOP_TIMEOUT):
+    """
+        Asks the process that records the job to stop and waits until the
+        wav file is saved. Returns False if it was not saved in time.
+    """
+
+    request_stop(store, job)
+    deadline = time.time() + timeout
+    while job.status == STOPPING and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        job = store.get(job.id) or job
+    return job.status == RECORDED
+
+
+# 提取音符并将乐谱pdf保存在note_pdf/<id>文件夹下；progress 接收各阶段名，
+# stage_cache（stage_cache.StageCache）缓存各阶段的结果，render_cache（render_cache.RenderCache）缓存 LilyPond 的输出，
+# engraver（engraver.BatchEngraver）与其他任务的乐谱一起打谱
+def get_notes(job, resample_quality=DEFAULT_QUALITY, progress=None, stage_cache=None, render_cache=None,
+              engraver=None):
+    transcriber = music_transcriber.MusicTranscriber(job.wav_file, resample_quality=resample_quality,
+                                                     output_dir=job.pdf_dir, progress=progress,
+                                                     stage_cache=stage_cache, render_cache=render_cache,
+                                                     engraver=engraver)
+    notes, durations = transcriber.transcribe()
+    durations = [i * 2 for i in durations]
+    melody = [tuple(i) for i in zip(notes, durations)]
+    return melody
+
+
+# 设置乐器：https://blog.csdn.net/ruyulin/article/details/84103186
+def choose_program(store, job, program=0):
+    job.program = program
+    store.save(job)
+
+
+# 音符转乐器音并将mid文件保存在compose_mid/<id>文件夹下
+def create_melody(store, job, melody):
+    job.composer(melody)
+    job.status = COMPOSED
+    store.save(job)
+
+
+# 播放保存的mid文件
+def play_music(job):
+    if os.path.exists(job.mid_file):
+        job.composer().play_midi()
+
+
+# mid转wav
+def mid2wav(job):
+    if os.path.exists(job.mid_file):
+        job.composer().transfer_wav()
@@ -0,0 +1,88 @@
+import numpy as np
+from melody_note.work.wav_note.wav_reader import open_wav
+
+
+class AudioSegment(object):
+    """
+        A lightweight view (offset, length, frame rate) into a PCM buffer
+        shared by all segments of a recording. Slicing a segment never
+        copies samples.
+    """
+
+    def __init__(self, buffer, framerate, offset=0, length=None):
+        # buffer: int16 array of shape (nframes, nchannels), or float samples
+        # on the same scale (e.g. resample.decimate output)
+        self.buffer = buffer
+        self.framerate = framerate
+        self.offset = offset
+        if length is None:
+            length = len(buffer) - offset
+        self.length = max(0, min(length, len(buffer) - offset))
+
+    @classmethod
+    def from_bytes(cls, data, framerate, nchannels):
+        """
+            Wraps raw 16-bit PCM frames (as returned by readframes).
+        """
+
+        buffer = np.frombuffer(data, dtype=np.short)
+        return cls(buffer[:len(buffer) // nchannels * nchannels].reshape(-1, nchannels), framerate)
+
+    @classmethod
+    def from_file(cls, wav_file):
+        """
+            Maps a 16-bit wav file (see wav_reader.open_wav); the segment
+            and all its slices read the PCM data in place.
+        """
+
+        params, data = open_wav(wav_file)
+        return cls(data, params.framerate)
+
+    @property
+    def nchannels(self):
+        return self.buffer.shape[1]
+
+    @property
+    def duration(self):
+        return self.length / float(self.framerate)
+
+    @property
+    def samples(self):
+        """
+            The segment's samples, shaped like scipy.io.wavfile.read output:
+            1-D for mono, (nframes, nchannels) otherwise.
+        """
+
+        frames = self.buffer[self.offset:self.offset + self.length]
+        if self.nchannels == 1:
+            return frames[:, 0]
+        return frames
+
+    def slice(self, offset, length):
+        """
+            Returns a sub-segment starting `offset` frames into this one.
+        """
+
+        return AudioSegment(self.buffer, self.framerate, self.offset + offset,
+                            min(length, self.length - offset))
+
+    def tobytes(self):
+        """
+            The segment's frames as 16-bit PCM; float buffers are rounded.
+        """
+
+        frames = self.buffer[self.offset:self.offset + self.length]
+        if frames.dtype != np.short:
+            frames = np.clip(np.rint(frames), -32768, 32767).astype(np.short)
+        return frames.tobytes()
+
+
+def as_segment(sound):
+    """
+        Returns sound itself if it is an AudioSegment, otherwise reads the
+        wav file it names.
+    """
+
+    if isinstance(sound, AudioSegment):
+        return sound
+    return AudioSegment.from_file(sound)
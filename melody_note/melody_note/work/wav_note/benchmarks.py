@@ -0,0 +1,793 @@
+"""
+    Benchmarks for the transcription pipeline.
+
+    Run from the Django project directory (the one containing manage.py):
+        python -m melody_note.work.wav_note.benchmarks <name> [args ...]
+    where <name> is one of the keys of BENCHMARKS.
+"""
+import difflib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from melody_note.work.wav_note import speech_enhance
+
+
+def synthetic_recording(seconds, fs=64000, seed=0):
+    """
+        Returns a hummed-melody-like int16 signal: half a second of noise
+        followed by a sequence of harmonic tones buried in white noise.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = int(seconds * fs)
+    note_len = fs // 2
+    midi = 60 + rng.integers(0, 12, size=n // note_len + 1)
+    f0 = np.repeat(440.0 * 2 ** ((midi - 69) / 12.0), note_len)[:n]
+    phase = 2 * np.pi * np.cumsum(f0) / fs
+    x = sum(np.sin(h * phase) / h for h in (1, 2, 3))
+    x[:note_len] = 0
+    x = 8000 * x + 500 * rng.standard_normal(n)
+    return np.clip(x, -32768, 32767).astype(np.short)
+
+
+def best_of(func, repeat=3):
+    """
+        Returns the best wall time of `repeat` calls and the last result.
+    """
+
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def write_wav(music_file, x, fs=64000):
+    """
+        Writes mono int16 samples to a 16-bit wav file.
+    """
+
+    speech_enhance.write_wav(music_file, (1, 2, fs, len(x), 'NONE', 'not compressed'), x)
+
+
+def flatten(notes):
+    """
+        The notes of every segment, in one list.
+    """
+
+    return [n for segment_notes in notes for n in segment_notes]
+
+
+def similarity(a, b):
+    """
+        Similarity (difflib ratio) of two note sequences.
+    """
+
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def bench_denoise(lengths=(10, 30, 60, 120), fs=64000):
+    """
+        Times the frame-by-frame and batched spectral subtraction engines
+        (float64 and float32) by recording length and checks that their
+        outputs agree.
+    """
+
+    print('%8s %10s %12s %12s %8s %12s %12s' % ('seconds', 'loop (s)', 'batch64 (s)', 'batch32 (s)',
+                                                 'speedup', 'err float64', 'err float32'))
+    for seconds in lengths:
+        x = synthetic_recording(seconds, fs)
+        t_loop, ref = best_of(lambda: speech_enhance.spectral_subtraction_loop(x, fs), repeat=1)
+        t_64, out_64 = best_of(lambda: speech_enhance.spectral_subtraction_batch(x, fs, dtype=np.float64))
+        t_32, out_32 = best_of(lambda: speech_enhance.spectral_subtraction_batch(x, fs, dtype=np.float32))
+        err_64 = np.abs(ref - out_64).max() / np.abs(ref).max()
+        err_32 = np.abs(ref - out_32).max() / np.abs(ref).max()
+        assert err_64 < speech_enhance.BATCH_RTOL, err_64
+        assert err_32 < speech_enhance.FLOAT32_RTOL, err_32
+        print('%8g %10.3f %12.3f %12.3f %7.1fx %12.2e %12.2e' % (
+            seconds, t_loop, t_64, t_32, t_loop / t_32, err_64, err_32))
+
+
+def bench_jit(lengths=(10, 30, 60, 120), fs=64000):
+    """
+        Reports the numba compile/warm-up cost once, then the steady-state
+        throughput of the numpy and compiled noise-subtraction engines.
+    """
+
+    if speech_enhance.numba is None:
+        print('numba is not installed, the jit engine falls back to numpy')
+    print('compile/warm-up: %.3f s' % (speech_enhance.warm_up_jit(),))
+    print('%8s %10s %10s %8s %14s' % ('seconds', 'batch (s)', 'jit (s)', 'speedup', 'jit audio s/s'))
+    for seconds in lengths:
+        x = synthetic_recording(seconds, fs)
+        t_batch, ref = best_of(lambda: speech_enhance.spectral_subtraction_batch(x, fs))
+        t_jit, out = best_of(lambda: speech_enhance.spectral_subtraction_jit(x, fs))
+        # 两者均为 float32，求和顺序不同
+        assert np.abs(ref - out).max() / np.abs(ref).max() < speech_enhance.FLOAT32_RTOL
+        print('%8g %10.3f %10.3f %7.1fx %14.0f' % (seconds, t_batch, t_jit, t_batch / t_jit, seconds / t_jit))
+
+
+def peak_memory(func):
+    """
+        Returns the peak traced allocation (bytes) while running func.
+    """
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_stream(lengths=(10, 60, 300), fs=64000, block_frames=65536):
+    """
+        Compares peak memory of the batch and streaming denoisers.
+        The streaming input is generated block by block so that only the
+        denoiser's own working set is measured.
+    """
+
+    def blocks(seconds):
+        for i in range(int(seconds * fs) // block_frames + 1):
+            yield synthetic_recording(block_frames / fs, fs, seed=i)
+
+    def run_stream(seconds):
+        for out in speech_enhance.noise_reduction_stream(blocks(seconds), fs):
+            pass
+
+    print('%8s %16s %16s' % ('seconds', 'batch peak (MB)', 'stream peak (MB)'))
+    for seconds in lengths:
+        x = np.concatenate(list(blocks(seconds)))
+        batch = peak_memory(lambda: speech_enhance.spectral_subtraction_batch(x, fs))
+        stream = peak_memory(lambda: run_stream(seconds))
+        print('%8g %16.1f %16.1f' % (seconds, batch / 2 ** 20, stream / 2 ** 20))
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+
+
+def bench_handoff(names=('star', 'twinkle_short', 'piano')):
+    """
+        Latency of getting the denoised signal into onset detection:
+        _no_noise.wav round trip vs in-memory handoff, with and without
+        the optional debug artifact.
+    """
+
+    import librosa
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    def round_trip(splitter):
+        speech_enhance.noise_reduction(splitter.music_file, splitter.music_file_no_noice)
+        return librosa.load(splitter.music_file_no_noice)
+
+    print('%14s %16s %16s %18s' % ('file', 'round trip (s)', 'in memory (s)', 'with artifact (s)'))
+    scratch = tempfile.mkdtemp()
+    for name in names:
+        # 复制到临时目录，避免覆盖 examples 中的 _no_noise.wav
+        music_file = shutil.copy(os.path.join(EXAMPLES_DIR, name + '.wav'), scratch)
+        splitter = OnsetFrameSplitter(music_file, None)
+        t_file, _ = best_of(lambda: round_trip(splitter))
+        t_memory, _ = best_of(splitter.denoised_signal)
+        splitter.save_no_noise = True
+        t_artifact, _ = best_of(splitter.denoised_signal)
+        print('%14s %16.3f %16.3f %18.3f' % (name, t_file, t_memory, t_artifact))
+    shutil.rmtree(scratch)
+
+
+def synthetic_segments(onsets, fs=64000, seed=0):
+    """
+        Splits a synthetic recording into `onsets` segments of random length
+        between 0.1 and 0.6 seconds.
+    """
+
+    from melody_note.work.wav_note.audio_segment import AudioSegment
+
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(fs // 10, 6 * fs // 10, size=onsets)
+    recording = AudioSegment(synthetic_recording(lengths.sum() / fs + 1, fs, seed)[:, np.newaxis], fs)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return [recording.slice(o, l) for o, l in zip(offsets, lengths)]
+
+
+def bench_pitch_batch(onset_counts=(10, 100, 1000), fs=64000):
+    """
+        Per-file MIDI_Detector loop (note%d.wav files, as the pipeline used
+        to do) vs per-segment loop in memory vs one batched call.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method
+
+    def per_file(directory, count):
+        return [first_peaks_method.MIDI_Detector(os.path.join(directory, 'note%d.wav' % (i,))).detect_MIDI_notes()
+                for i in range(count)]
+
+    print('%8s %14s %16s %12s %8s' % ('onsets', 'per file (s)', 'per segment (s)', 'batch (s)', 'speedup'))
+    for count in onset_counts:
+        count = int(count)
+        segments = synthetic_segments(count, fs)
+        scratch = tempfile.mkdtemp()
+        for i, segment in enumerate(segments):
+            write_wav(os.path.join(scratch, 'note%d.wav' % (i,)), segment.samples, fs)
+        t_file, ref = best_of(lambda: per_file(scratch, count), repeat=1)
+        t_segment, _ = best_of(lambda: [first_peaks_method.MIDI_Detector(s).detect_MIDI_notes() for s in segments], repeat=1)
+        t_batch, (notes, durations) = best_of(lambda: first_peaks_method.detect_MIDI_notes_batch(segments))
+        shutil.rmtree(scratch)
+        assert [r[0] for r in ref] == notes
+        print('%8d %14.3f %16.3f %12.3f %7.1fx' % (count, t_file, t_segment, t_batch, t_file / t_batch))
+
+
+def synthetic_notes(count, fs=64000, min_seconds=0.2, max_seconds=0.6, seed=0):
+    """
+        Returns `count` single-note AudioSegments of random length with
+        known pitch, and their MIDI numbers.
+    """
+
+    from melody_note.work.wav_note.audio_segment import AudioSegment
+
+    rng = np.random.default_rng(seed)
+    midi = rng.integers(55, 80, size=count)
+    segments = []
+    for note in midi:
+        n = int(rng.uniform(min_seconds, max_seconds) * fs)
+        phase = 2 * np.pi * 440.0 * 2 ** ((note - 69) / 12.0) * np.arange(n) / fs
+        x = sum(np.sin(h * phase) / h for h in (1, 2, 3))
+        x = 8000 * x + 300 * rng.standard_normal(n)
+        segments.append(AudioSegment(x.astype(np.short)[:, np.newaxis], fs))
+    return segments, midi.tolist()
+
+
+def bench_fft_sizing(names=('star', 'twinkle_short', 'piano'), count=200):
+    """
+        Cost vs detection accuracy of the FFT sizing strategies: on short
+        synthetic notes with known pitch, and on the onset segments of the
+        bundled examples (agreement with the zero-padded result, which
+        discards no audio).
+    """
+
+    from melody_note.work.wav_note import first_peaks_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    def accuracy(notes, truth):
+        return np.mean([n[:1] == [t] for n, t in zip(notes, truth)])
+
+    segments, truth = synthetic_notes(int(count))
+    print('synthetic notes (%d, 0.2-0.6 s)' % (len(segments),))
+    print('%10s %10s %10s' % ('sizing', 'time (s)', 'accuracy'))
+    for sizing in first_peaks_method.FFT_SIZING:
+        t, (notes, durations) = best_of(
+            lambda: first_peaks_method.detect_MIDI_notes_batch(segments, fft_sizing=sizing))
+        print('%10s %10.3f %9.1f%%' % (sizing, t, 100 * accuracy(notes, truth)))
+
+    print('examples')
+    print('%14s %10s %10s %8s %12s' % ('file', 'sizing', 'time (s)', 'notes', 'agree w/ pad'))
+    for name in names:
+        segments = OnsetFrameSplitter(os.path.join(EXAMPLES_DIR, name + '.wav')).onset_frames_split()
+        reference = first_peaks_method.detect_MIDI_notes_batch(segments, fft_sizing='pad')[0]
+        for sizing in first_peaks_method.FFT_SIZING:
+            t, (notes, durations) = best_of(
+                lambda: first_peaks_method.detect_MIDI_notes_batch(segments, fft_sizing=sizing))
+            agree = np.mean([a == b for a, b in zip(notes, reference)])
+            print('%14s %10s %10.3f %8d %11.1f%%' % (name, sizing, t, sum(len(n) for n in notes), 100 * agree))
+
+
+def bench_pitch_engine(names=('star', 'twinkle_short', 'piano'), count=200):
+    """
+        Speed and accuracy of the first-peaks and piano-key pitch engines:
+        on synthetic notes with known pitch, and agreement between the two
+        engines on the onset segments of the bundled examples.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method, piano_key_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    engines = (('first_peaks', first_peaks_method.detect_MIDI_notes_batch),
+               ('piano_key', piano_key_method.detect_MIDI_notes_batch))
+
+    segments, truth = synthetic_notes(int(count))
+    # 第一次调用时构建滤波器组
+    t_kernel, _ = best_of(lambda: piano_key_method.piano_key_kernel(64000), repeat=1)
+    print('piano key kernel build: %.3f s' % (t_kernel,))
+    print('synthetic notes (%d, 0.2-0.6 s)' % (len(segments),))
+    print('%12s %10s %10s' % ('engine', 'time (s)', 'accuracy'))
+    for engine, detect in engines:
+        t, (notes, durations) = best_of(lambda: detect(segments))
+        accuracy = np.mean([n[:1] == [m] for n, m in zip(notes, truth)])
+        print('%12s %10.3f %9.1f%%' % (engine, t, 100 * accuracy))
+
+    print('examples')
+    print('%14s %16s %14s %8s' % ('file', 'first_peaks (s)', 'piano_key (s)', 'agree'))
+    for name in names:
+        segments = OnsetFrameSplitter(os.path.join(EXAMPLES_DIR, name + '.wav')).onset_frames_split()
+        (t_peaks, (peaks, _)), (t_keys, (keys, _)) = [best_of(lambda: detect(segments)) for engine, detect in engines]
+        agree = np.mean([a == b for a, b in zip(peaks, keys)])
+        print('%14s %16.3f %14.3f %7.1f%%' % (name, t_peaks, t_keys, 100 * agree))
+
+
+def synthetic_melody(count, fs=64000, seed=0):
+    """
+        Returns an int16 recording of `count` plucked harmonic notes of
+        random pitch and length (0.3-0.6 s) after half a second of noise,
+        and their MIDI numbers. Every note starts with an attack, so
+        repeated pitches are separate notes.
+    """
+
+    rng = np.random.default_rng(seed)
+    midi = rng.integers(55, 80, size=count)
+    parts = [np.zeros(fs // 2)]
+    for note in midi:
+        t = np.arange(int(rng.uniform(0.3, 0.6) * fs)) / fs
+        phase = 2 * np.pi * 440.0 * 2 ** ((note - 69) / 12.0) * t
+        parts.append(np.exp(-3 * t) * sum(np.sin(h * phase) / h for h in (1, 2, 3)))
+    x = 8000 * np.concatenate(parts)
+    x += 300 * rng.standard_normal(len(x))
+    return np.clip(x, -32768, 32767).astype(np.short), midi.tolist()
+
+
+def bench_yin(counts=(20, 100), names=('star', 'twinkle_short', 'piano')):
+    """
+        Onset split + MIDI_Detector (batched) vs frame-level YIN tracking,
+        both from the wav file to (notes, durations) without LilyPond. The
+        denoising both pipelines share is timed separately. Accuracy is the
+        similarity (difflib ratio) of the note sequence with the truth, and
+        between the two pipelines on the bundled examples.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method, yin_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    def split_notes(splitter):
+        return flatten(first_peaks_method.detect_MIDI_notes_batch(splitter.onset_frames_split())[0])
+
+    def compare(music_file):
+        splitter = OnsetFrameSplitter(music_file)
+        t_denoise, (y, sr) = best_of(splitter.denoised_signal)
+        t_split, split = best_of(lambda: split_notes(splitter))
+        t_yin, (yin, durations) = best_of(lambda: yin_method.detect_notes(y, sr))
+        return t_denoise, t_split, t_denoise + t_yin, split, yin
+
+    print('%10s %12s %12s %10s %10s %10s' % ('notes', 'denoise (s)', 'split total', 'yin total', 'split acc', 'yin acc'))
+    scratch = tempfile.mkdtemp()
+    for count in counts:
+        x, truth = synthetic_melody(int(count))
+        music_file = os.path.join(scratch, 'melody%d.wav' % (count,))
+        write_wav(music_file, x)
+        t_denoise, t_split, t_yin, split, yin = compare(music_file)
+        print('%10d %12.3f %12.3f %10.3f %9.1f%% %9.1f%%' % (
+            count, t_denoise, t_split, t_yin, 100 * similarity(split, truth), 100 * similarity(yin, truth)))
+    shutil.rmtree(scratch)
+
+    print('%14s %12s %12s %10s %10s' % ('file', 'denoise (s)', 'split total', 'yin total', 'agree'))
+    for name in names:
+        t_denoise, t_split, t_yin, split, yin = compare(os.path.join(EXAMPLES_DIR, name + '.wav'))
+        print('%14s %12.3f %12.3f %10.3f %9.1f%%' % (name, t_denoise, t_split, t_yin, 100 * similarity(split, yin)))
+
+
+def bench_shared_stft(counts=(20, 100), names=('star', 'twinkle_short', 'piano')):
+    """
+        Split pipeline (denoise, librosa resample + onset detection, one FFT
+        per segment) vs the shared-spectrogram pipeline (one STFT reused by
+        all stages), from the wav file to the notes of every segment.
+        Accuracy is the similarity (difflib ratio) of the note sequence with
+        the truth, and between the two pipelines on the bundled examples.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+    from melody_note.work.wav_note.shared_spectrum import SharedSpectrum, load_mono
+
+    def split(music_file):
+        segments = OnsetFrameSplitter(music_file).onset_frames_split()
+        return flatten(first_peaks_method.detect_MIDI_notes_batch(segments)[0])
+
+    def shared(music_file):
+        params, x = load_mono(music_file)
+        return flatten(SharedSpectrum(x, params[2]).detect_MIDI_notes()[0])
+
+    print('%10s %10s %11s %8s %10s %11s' % ('notes', 'split (s)', 'shared (s)', 'speedup', 'split acc', 'shared acc'))
+    scratch = tempfile.mkdtemp()
+    for count in counts:
+        x, truth = synthetic_melody(int(count))
+        music_file = os.path.join(scratch, 'melody%d.wav' % (count,))
+        write_wav(music_file, x)
+        t_split, split_notes = best_of(lambda: split(music_file))
+        t_shared, shared_notes = best_of(lambda: shared(music_file))
+        print('%10d %10.3f %11.3f %7.1fx %9.1f%% %10.1f%%' % (
+            count, t_split, t_shared, t_split / t_shared,
+            100 * similarity(split_notes, truth), 100 * similarity(shared_notes, truth)))
+    shutil.rmtree(scratch)
+
+    print('%14s %10s %11s %8s %10s' % ('file', 'split (s)', 'shared (s)', 'speedup', 'agree'))
+    for name in names:
+        music_file = os.path.join(EXAMPLES_DIR, name + '.wav')
+        t_split, split_notes = best_of(lambda: split(music_file))
+        t_shared, shared_notes = best_of(lambda: shared(music_file))
+        print('%14s %10.3f %11.3f %7.1fx %9.1f%%' % (
+            name, t_split, t_shared, t_split / t_shared, 100 * similarity(split_notes, shared_notes)))
+
+
+def bench_analysis_rate(rates=(64000, 22050, 16000, 11025, 8000), count=40,
+                        names=('star', 'twinkle_short', 'piano')):
+    """
+        Per-stage time (decimation, denoise, onsets, pitch) and note
+        accuracy of the split pipeline at several analysis rates: on a
+        synthetic 64 kHz melody (similarity with the truth), and on the
+        bundled examples (similarity with the full-rate notes).
+    """
+
+    from melody_note.work.wav_note import first_peaks_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+    from melody_note.work.wav_note.audio_segment import AudioSegment
+    from melody_note.work.wav_note.resample import decimate
+
+    def stages(music_file, rate):
+        original = AudioSegment.from_file(music_file)
+        t_decimate, recording = best_of(lambda: decimate(original, rate))
+        t_denoise, _ = best_of(lambda: speech_enhance.denoise_samples(recording.buffer.ravel(), recording.framerate))
+        t_split, segments = best_of(OnsetFrameSplitter(music_file, recording=recording).onset_frames_split)
+        t_pitch, (notes, durations) = best_of(lambda: first_peaks_method.detect_MIDI_notes_batch(segments))
+        return (t_decimate, t_denoise, t_split - t_denoise, t_pitch), flatten(notes)
+
+    scratch = tempfile.mkdtemp()
+    x, truth = synthetic_melody(int(count))
+    music_file = os.path.join(scratch, 'melody.wav')
+    write_wav(music_file, x)
+    print('synthetic melody (%d notes)' % (len(truth),))
+    print('%8s %10s %10s %10s %10s %10s %9s' % ('rate', 'decimate', 'denoise', 'onsets', 'pitch', 'total (s)', 'accuracy'))
+    for rate in rates:
+        times, notes = stages(music_file, rate)
+        print('%8d %10.3f %10.3f %10.3f %10.3f %10.3f %8.1f%%' % ((rate,) + times + (sum(times), 100 * similarity(notes, truth))))
+
+    print('examples (agreement with the full rate)')
+    print('%14s %8s %10s %9s' % ('file', 'rate', 'total (s)', 'agree'))
+    for name in names:
+        music_file = os.path.join(EXAMPLES_DIR, name + '.wav')
+        reference = None
+        for rate in rates:
+            times, notes = stages(music_file, rate)
+            if reference is None:
+                reference = notes
+            print('%14s %8d %10.3f %8.1f%%' % (name, rate, sum(times), 100 * similarity(notes, reference)))
+    shutil.rmtree(scratch)
+
+
+def bench_resample(names=('star', 'twinkle_short', 'piano'), seconds=(5, 30)):
+    """
+        Load + resample to the onset rate: librosa.load of the _no_noise.wav
+        file, librosa.resample of the PCM in memory, and the cached
+        polyphase resampler per quality profile. Onset agreement is the
+        share of librosa-resampled onsets found within 30 ms.
+    """
+
+    import librosa
+    from melody_note.work.wav_note import resample
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    sr = OnsetFrameSplitter.ONSET_SAMPLE_RATE
+
+    def onsets(y):
+        return librosa.onset.onset_detect(y=y, sr=sr, units='time')
+
+    def agreement(found, reference):
+        if len(reference) == 0:
+            return 1.0
+        return np.mean([np.abs(np.asarray(found) - t).min() <= 0.03 if len(found) else False for t in reference])
+
+    scratch = tempfile.mkdtemp()
+    files = [os.path.join(EXAMPLES_DIR, name + '.wav') for name in names]
+    for length in seconds:
+        music_file = os.path.join(scratch, 'recording%d.wav' % (length,))
+        write_wav(music_file, synthetic_recording(length))
+        files.append(music_file)
+
+    print('%14s %18s' % ('quality', 'filter design (s)'))
+    for quality in resample.QUALITY:
+        resample.design_filter.cache_clear()
+        t, _ = best_of(lambda: resample.design_filter(64000, sr, quality), repeat=1)
+        print('%14s %18.4f' % (quality, t))
+
+    print('%16s %14s %10s %9s' % ('file', 'resampler', 'time (s)', 'onsets'))
+    for music_file in files:
+        name = os.path.splitext(os.path.basename(music_file))[0]
+        no_noise = os.path.join(scratch, 'no_noise.wav')
+        params, x = speech_enhance.denoise(music_file)
+        speech_enhance.write_wav(no_noise, params, x)
+        y = x.astype(np.float32) / 32768
+        framerate = params[2]
+        t, (reference, _) = best_of(lambda: librosa.load(no_noise))
+        print('%16s %14s %10.4f %9s' % (name, 'librosa.load', t, '-'))
+        t, reference = best_of(lambda: librosa.resample(y, orig_sr=framerate, target_sr=sr))
+        reference = onsets(reference)
+        print('%16s %14s %10.4f %8.1f%%' % (name, 'librosa', t, 100.0))
+        for quality in resample.QUALITIES:
+            t, out = best_of(lambda: resample.resample(y, framerate, sr, quality))
+            print('%16s %14s %10.4f %8.1f%%' % (name, quality, t, 100 * agreement(onsets(out), reference)))
+    shutil.rmtree(scratch)
+
+
+def bench_vad(silences=(0, 2, 5), count=20, names=('star', 'twinkle_short', 'piano')):
+    """
+        Split pipeline with and without the VAD trimming stage on a
+        synthetic melody with `silence` seconds of (noisy) silence at both
+        ends and in the middle, and on the bundled examples. Reports time,
+        analysed seconds, segments and the similarity of the note sequences.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+
+    def transcribe(music_file, trim):
+        segments = OnsetFrameSplitter(music_file, trim_silence=trim).onset_frames_split()
+        return flatten(first_peaks_method.detect_MIDI_notes_batch(segments)[0]), segments
+
+    def compare(music_file, truth=None):
+        t_full, (full, full_segments) = best_of(lambda: transcribe(music_file, False))
+        t_trim, (trim, trim_segments) = best_of(lambda: transcribe(music_file, True))
+        reference = full if truth is None else truth
+        return (t_full, t_trim, sum(s.duration for s in trim_segments), len(full_segments), len(trim_segments),
+                100 * similarity(full, reference), 100 * similarity(trim, reference))
+
+    fs = 64000
+    print('%8s %9s %9s %11s %10s %10s %9s %9s' % (
+        'silence', 'full (s)', 'trim (s)', 'analysed s', 'full segs', 'trim segs', 'full acc', 'trim acc'))
+    scratch = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    x, truth = synthetic_melody(count, fs)
+    half = len(x) // 2
+    for silence in silences:
+        gap = (300 * rng.standard_normal(int(silence * fs))).astype(np.short)
+        y = np.concatenate((x[:fs // 2], gap, x[fs // 2:half], gap, x[half:], gap))
+        music_file = os.path.join(scratch, 'melody.wav')
+        write_wav(music_file, y, fs)
+        print('%8g %9.3f %9.3f %11.2f %10d %10d %8.1f%% %8.1f%%' % ((silence,) + compare(music_file, truth)))
+    shutil.rmtree(scratch)
+
+    print('examples (accuracy: similarity with the untrimmed notes)')
+    for name in names:
+        print('%8s %9.3f %9.3f %11.2f %10d %10d %8.1f%% %8.1f%%' % (
+            (name,) + compare(os.path.join(EXAMPLES_DIR, name + '.wav'))))
+
+
+def bench_wav_reader(lengths=(10, 60, 300), fs=64000, onsets=100):
+    """
+        Reading a recording and slicing it into `onsets` segments with
+        wave.readframes + np.frombuffer vs the memory-mapped reader: time
+        and peak Python allocations (the mapped pages are not counted, they
+        belong to the page cache).
+    """
+
+    import wave
+    from melody_note.work.wav_note.audio_segment import AudioSegment
+    from melody_note.work.wav_note.wav_reader import open_wav
+
+    def read_frames(music_file):
+        with wave.open(music_file, 'rb') as w:
+            params = w.getparams()
+            recording = AudioSegment.from_bytes(w.readframes(params.nframes), params.framerate, params.nchannels)
+        step = recording.length // onsets
+        return [recording.slice(i * step, step).samples.sum() for i in range(onsets)]
+
+    def read_memmap(music_file):
+        params, data = open_wav(music_file)
+        recording = AudioSegment(data, params.framerate)
+        step = recording.length // onsets
+        return [recording.slice(i * step, step).samples.sum() for i in range(onsets)]
+
+    print('%8s %16s %14s %18s %16s' % ('seconds', 'readframes (s)', 'memmap (s)', 'readframes (MB)', 'memmap (MB)'))
+    scratch = tempfile.mkdtemp()
+    for seconds in lengths:
+        music_file = os.path.join(scratch, 'recording.wav')
+        with wave.open(music_file, 'wb') as w:
+            w.setparams((1, 2, fs, int(seconds * fs), 'NONE', 'not compressed'))
+            for i in range(int(seconds)):
+                w.writeframes(synthetic_recording(1, fs, seed=i).tobytes())
+        t_frames, ref = best_of(lambda: read_frames(music_file))
+        t_memmap, out = best_of(lambda: read_memmap(music_file))
+        assert ref == out
+        m_frames = peak_memory(lambda: read_frames(music_file))
+        m_memmap = peak_memory(lambda: read_memmap(music_file))
+        print('%8g %16.4f %14.4f %18.1f %16.1f' % (seconds, t_frames, t_memmap, m_frames / 2 ** 20, m_memmap / 2 ** 20))
+    shutil.rmtree(scratch)
+
+
+def bench_dtype(names=('star', 'twinkle_short', 'piano'), count=40):
+    """
+        Regression check of the dtype policy (dtypes.py): every pitch engine
+        run from the wav file to the MIDI notes in float64 and in float32.
+        Reports time, peak Python allocations and note accuracy: similarity
+        with the truth on a synthetic melody, and agreement of the float32
+        notes with the float64 ones on the bundled examples.
+    """
+
+    from melody_note.work.wav_note import first_peaks_method, piano_key_method, yin_method
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+    from melody_note.work.wav_note.shared_spectrum import SharedSpectrum, load_mono
+
+    def split_engine(detect):
+        def run(music_file, dtype):
+            segments = OnsetFrameSplitter(music_file, dtype=dtype).onset_frames_split()
+            return flatten(detect(segments, dtype=dtype)[0])
+        return run
+
+    def yin(music_file, dtype):
+        y, sr = OnsetFrameSplitter(music_file, dtype=dtype).denoised_signal()
+        return yin_method.detect_notes(y, sr, dtype)[0]
+
+    def shared(music_file, dtype):
+        params, x = load_mono(music_file, dtype)
+        return flatten(SharedSpectrum(x, params[2], dtype=dtype).detect_MIDI_notes()[0])
+
+    engines = (('first_peaks', split_engine(first_peaks_method.detect_MIDI_notes_batch)),
+               ('piano_key', split_engine(piano_key_method.detect_MIDI_notes_batch)),
+               ('yin', yin),
+               ('shared_stft', shared))
+
+    def compare(music_file, run):
+        t_64, notes_64 = best_of(lambda: run(music_file, np.float64))
+        t_32, notes_32 = best_of(lambda: run(music_file, np.float32))
+        m_64 = peak_memory(lambda: run(music_file, np.float64))
+        m_32 = peak_memory(lambda: run(music_file, np.float32))
+        return t_64, t_32, m_64 / 2 ** 20, m_32 / 2 ** 20, notes_64, notes_32
+
+    header = '%14s %12s %10s %10s %10s %10s %10s %10s'
+    row = '%14s %12s %10.3f %10.3f %10.1f %10.1f %9.1f%% %9.1f%%'
+    scratch = tempfile.mkdtemp()
+    x, truth = synthetic_melody(int(count))
+    music_file = os.path.join(scratch, 'melody.wav')
+    write_wav(music_file, x)
+    print('synthetic melody (%d notes), accuracy: similarity with the truth' % (len(truth),))
+    print(header % ('', 'engine', '64 (s)', '32 (s)', '64 (MB)', '32 (MB)', 'acc 64', 'acc 32'))
+    for engine, run in engines:
+        t_64, t_32, m_64, m_32, notes_64, notes_32 = compare(music_file, run)
+        print(row % ('melody', engine, t_64, t_32, m_64, m_32,
+                     100 * similarity(notes_64, truth), 100 * similarity(notes_32, truth)))
+    shutil.rmtree(scratch)
+
+    print('examples, agreement of the float32 notes with the float64 notes')
+    print(header % ('file', 'engine', '64 (s)', '32 (s)', '64 (MB)', '32 (MB)', 'notes', 'agree'))
+    for name in names:
+        for engine, run in engines:
+            t_64, t_32, m_64, m_32, notes_64, notes_32 = compare(os.path.join(EXAMPLES_DIR, name + '.wav'), run)
+            print(row.replace('%9.1f%% %9.1f%%', '%10d %9.1f%%') % (
+                name, engine, t_64, t_32, m_64, m_32, len(notes_64), 100 * similarity(notes_64, notes_32)))
+
+
+def bench_stage_cache(names=('star', 'twinkle_short', 'piano')):
+    """
+        Times a transcription without the stage cache, with a cold cache, a
+        repeated one (only the score is republished) and one with only the
+        FFT sizing changed (denoising and onsets are reused), and checks
+        that all of them give the same notes.
+    """
+
+    from melody_note.work.wav_note.music_transcriber import MusicTranscriber
+    from melody_note.work.wav_note.stage_cache import StageCache
+
+    scratch = tempfile.mkdtemp()
+    cache = StageCache(os.path.join(scratch, 'cache'))
+
+    def run(name, stage_cache=None, fft_sizing='truncate'):
+        # 转换时 .ly 发布在录音旁边，所以使用临时目录中的副本
+        transcriber = MusicTranscriber(os.path.join(scratch, name + '.wav'), fft_sizing=fft_sizing,
+                                       output_dir=os.path.join(scratch, 'pdf'), stage_cache=stage_cache)
+        return best_of(transcriber.transcribe, repeat=1)
+
+    print('%14s %10s %10s %10s %12s' % ('file', 'none (s)', 'cold (s)', 'warm (s)', 'changed (s)'))
+    for name in names:
+        shutil.copy(os.path.join(EXAMPLES_DIR, name + '.wav'), scratch)
+        t_none, ref = run(name)
+        t_cold, cold = run(name, cache)
+        t_warm, warm = run(name, cache)
+        t_changed, changed = run(name, cache, 'pad')
+        assert list(ref[0]) == list(cold[0]) == list(warm[0]), name
+        print('%14s %10.3f %10.3f %10.4f %12.3f' % (name, t_none, t_cold, t_warm, t_changed))
+    print('hits %(hits)s, misses %(misses)s' % cache.stats())
+    shutil.rmtree(scratch)
+
+
+def bench_render_cache(names=('star', 'twinkle_short', 'piano'), repeat=3):
+    """
+        Times engraving the score of each example with LilyPond and from
+        the render cache (needs LilyPond, see plotNotes.LILYPOND).
+    """
+
+    from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
+    from melody_note.work.wav_note.plotNotes import NotePlotter, lilypond_version
+    from melody_note.work.wav_note.render_cache import RenderCache
+
+    if lilypond_version() is None:
+        print('LilyPond is not available, nothing to measure')
+        return
+    print(lilypond_version())
+    scratch = tempfile.mkdtemp()
+    cache = RenderCache(os.path.join(scratch, 'cache'))
+    print('%14s %14s %14s' % ('file', 'lilypond (s)', 'cached (s)'))
+    for name in names:
+        shutil.copy(os.path.join(EXAMPLES_DIR, name + '.wav'), scratch)
+        music_file = os.path.join(scratch, name + '.wav')
+        plotter = NotePlotter(music_file, output_dir=os.path.join(scratch, 'pdf'))
+        segments = OnsetFrameSplitter(music_file).onset_frames_split()
+        detection = plotter.detect_notes(segments)
+        t_lilypond, _ = best_of(lambda: plotter.plot_segment_notes(*detection), repeat)
+        plotter.render_cache = cache
+        plotter.plot_segment_notes(*detection)
+        t_cached, _ = best_of(lambda: plotter.plot_segment_notes(*detection), repeat)
+        print('%14s %14.3f %14.4f' % (name, t_lilypond, t_cached))
+    print('hits %(hits)s, misses %(misses)s' % cache.stats())
+    shutil.rmtree(scratch)
+
+
+def bench_engraver(counts=(1, 4, 16), window=0.2):
+    """
+        Engraving throughput of N different scores submitted at once: one
+        LilyPond run per score (N threads) against a BatchEngraver that
+        engraves them in one run (needs LilyPond, see plotNotes.LILYPOND).
+    """
+
+    import concurrent.futures
+    from melody_note.work.wav_note.engraver import BatchEngraver
+    from melody_note.work.wav_note.plotNotes import NotePlotter, lilypond_version
+
+    if lilypond_version() is None:
+        print('LilyPond is not available, nothing to measure')
+        return
+    print(lilypond_version())
+    scratch = tempfile.mkdtemp()
+
+    def engrave_all(count, engraver):
+        def engrave(i):
+            # 每个乐谱不同，避免同一批中去重
+            plotter = NotePlotter(os.path.join(scratch, 'score%d.wav' % (i,)),
+                                  output_dir=os.path.join(scratch, 'pdf'), engraver=engraver)
+            plotter.plot_midi_notes([48 + i % 48, 60, 64, 67], [1, 1, 1, 1])
+        with concurrent.futures.ThreadPoolExecutor(count) as executor:
+            list(executor.map(engrave, range(int(count))))
+
+    print('%8s %14s %14s %10s %14s' % ('scores', 'separate (s)', 'batched (s)', 'speedup', 'scores/s'))
+    for count in counts:
+        t_separate, _ = best_of(lambda: engrave_all(count, None), repeat=1)
+        engraver = BatchEngraver(window=window, max_batch=int(count))
+        t_batched, _ = best_of(lambda: engrave_all(count, engraver), repeat=1)
+        print('%8d %14.3f %14.3f %9.1fx %14.2f' % (count, t_separate, t_batched, t_separate / t_batched,
+                                                 count / t_batched))
+    shutil.rmtree(scratch)
+
+
+BENCHMARKS = {
+    'denoise': bench_denoise,
+    'jit': bench_jit,
+    'stream': bench_stream,
+    'handoff': bench_handoff,
+    'pitch_batch': bench_pitch_batch,
+    'fft_sizing': bench_fft_sizing,
+    'pitch_engine': bench_pitch_engine,
+    'yin': bench_yin,
+    'shared_stft': bench_shared_stft,
+    'analysis_rate': bench_analysis_rate,
+    'resample': bench_resample,
+    'vad': bench_vad,
+    'wav_reader': bench_wav_reader,
+    'dtype': bench_dtype,
+    'stage_cache': bench_stage_cache,
+    'render_cache': bench_render_cache,
+    'engraver': bench_engraver,
+}
+
+
+def parse_arg(arg):
+    try:
+        return float(arg)
+    except ValueError:
+        return arg
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'denoise'
+    args = [parse_arg(a) for a in sys.argv[2:]]
+    if args:
+        BENCHMARKS[name](args)
+    else:
+        BENCHMARKS[name]()
@@ -0,0 +1,30 @@
+import numpy as np
+
+# Dtype policy of the transcription pipeline.
+#
+# PCM_DTYPE (16-bit PCM) is used only at the I/O boundaries: wav files,
+# AudioSegment buffers and the samples the denoiser hands back.
+#
+# Every analysis stage (noise reduction, onset detection, pitch detection)
+# converts the samples it reads to ANALYSIS_DTYPE once and keeps its
+# spectra in ANALYSIS_COMPLEX, which halves the memory traffic of the
+# FFT-heavy stages compared to float64/complex128.
+#
+# Per-frame scalars (SNR, energies in dB) and prefix sums over a whole
+# recording stay float64: their error would grow with the recording length.
+#
+# The stages take a `dtype` argument defaulting to ANALYSIS_DTYPE;
+# REFERENCE_DTYPE runs them in double precision, like the frame-by-frame
+# reference denoiser (benchmarks.bench_dtype compares the two).
+PCM_DTYPE = np.int16
+ANALYSIS_DTYPE = np.float32
+ANALYSIS_COMPLEX = np.complex64
+REFERENCE_DTYPE = np.float64
+
+
+def complex_dtype(dtype):
+    """
+        The complex dtype of the spectra of dtype samples.
+    """
+
+    return np.result_type(dtype, ANALYSIS_COMPLEX)
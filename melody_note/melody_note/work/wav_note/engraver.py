@@ -0,0 +1,111 @@
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+from .plotNotes import LILYPOND
+from .workspace import JobWorkspace
+
+
+class BatchEngraver(object):
+    """
+        Engraving service: scores submitted within `window` seconds of the
+        first waiting one (or until max_batch are waiting) are engraved by a
+        single LilyPond run, which pays the Guile and font start-up once
+        for all of them (like lilypond-book's process_snippets). Each score
+        gets its own basename in the batch's workspace; its .pdf and .mid
+        are then published to the destinations given with it.
+
+        engraver = BatchEngraver()
+        published = engraver.engrave(lilypond_text, {'.pdf': pdf_file, '.mid': mid_file})
+    """
+
+    def __init__(self, lilypond=LILYPOND, window=0.2, max_batch=16):
+        self.lilypond = lilypond
+        self.window = window
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        # (submit time, lilypond_text, destinations, future)
+        self.pending = []
+        self.worker = None
+        # LilyPond 调用次数与打谱数
+        self.runs = 0
+        self.scores = 0
+
+    def submit(self, lilypond_text, destinations):
+        """
+            Queues a score; the future resolves to the destinations of the
+            files LilyPond produced, by extension.
+        """
+
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.pending.append((time.time(), lilypond_text, destinations, future))
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+            self.condition.notify()
+        return future
+
+    def engrave(self, lilypond_text, destinations):
+        """
+            Engraves a score with the next batch and waits for it; returns
+            the published files by extension.
+        """
+
+        return self.submit(lilypond_text, destinations).result()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = self.pending[0][0] + self.window
+                while len(self.pending) < self.max_batch and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                batch = self.pending[:self.max_batch]
+                self.pending = self.pending[self.max_batch:]
+            try:
+                self.engrave_batch(batch)
+            except Exception as e:
+                for submitted, lilypond_text, destinations, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def engrave_batch(self, batch):
+        with JobWorkspace(prefix='melody_note_engrave_') as workspace:
+            # 同一批中相同的乐谱只打一次
+            names = {}
+            for submitted, lilypond_text, destinations, future in batch:
+                if lilypond_text not in names:
+                    names[lilypond_text] = 'score%d' % (len(names),)
+                    with open(workspace.file(names[lilypond_text] + '.ly'), 'w') as f:
+                        f.write(lilypond_text)
+            command = [self.lilypond] + [name + '.ly' for name in names.values()]
+            print ('Engraving %d scores: %s' % (len(names), ' '.join(command)))
+            try:
+                # 某个乐谱出错时 LilyPond 仍会处理其余文件
+                subprocess.call(command, cwd=workspace.path)
+            except OSError as e:
+                print ('LilyPond failed: ' + str(e))
+            with self.condition:
+                self.runs += 1
+                self.scores += len(names)
+            for submitted, lilypond_text, destinations, future in batch:
+                try:
+                    published = {}
+                    for ext, destination in destinations.items():
+                        output = names[lilypond_text] + ext
+                        if os.path.exists(workspace.file(output)):
+                            published[ext] = workspace.publish(output, destination)
+                    future.set_result(published)
+                except Exception as e:
+                    future.set_exception(e)
+
+    def stats(self):
+        """
+            LilyPond runs and scores engraved so far.
+        """
+
+        with self.condition:
+            return {'runs': self.runs, 'scores': self.scores}
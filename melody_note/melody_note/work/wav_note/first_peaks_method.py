@@ -1,12 +1,13 @@
 import sys
 import math
-import scipy
 import pylab
-import scipy.io.wavfile as wav
 import wave
 from scipy import signal
 from itertools import product
 import numpy
+from scipy.fft import next_fast_len
+from melody_note.work.wav_note.audio_segment import AudioSegment, as_segment
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE
 
 
 def readWav():
@@ -26,45 +27,53 @@ def readWav():
     print ("frame rate: %d " % (framerate,))
     print ("nframes: %d" % (nframes,))
     print ("duration: %f seconds" % (duration,))
-    print (scipy.array(sound_wave)
+    print (numpy.array(sound_wave)
 )
     return (sound_wave, nframes, framerate, duration, params)
 
 
+def getParams(sound_file):
+    """
+        Returns (nchannels, framerate, nframes) of a given sound file
+        or AudioSegment.
+    """
+
+    if isinstance(sound_file, AudioSegment):
+        return sound_file.nchannels, sound_file.framerate, sound_file.length
+    with wave.open(sound_file, 'r') as wr:
+        nchannels, sampwidth, framerate, nframes, comptype, compname = wr.getparams()
+    return nchannels, framerate, nframes
+
+
 def getDuration(sound_file):
     """
-        Returns the duration of a given sound file.
+        Returns the duration of a given sound file or AudioSegment.
     """
 
-    wr = wave.open(sound_file, 'r')
-    nchannels, sampwidth, framerate, nframes, comptype, compname =  wr.getparams()
+    nchannels, framerate, nframes = getParams(sound_file)
     return nframes / float(framerate)
 
 
 def getFrameRate(sound_file):
     """
-        Returns the frame rate of a given sound file.
+        Returns the frame rate of a given sound file or AudioSegment.
     """
 
-    wr = wave.open(sound_file, 'r')
-    nchannels, sampwidth, framerate, nframes, comptype, compname = wr.getparams()
-    return framerate
+    return getParams(sound_file)[1]
 
 def get_channels_no(sound_file):
     """
-        Returns number of channels of a given sound file.
+        Returns number of channels of a given sound file or AudioSegment.
     """
 
-    wr = wave.open(sound_file, 'r')
-    nchannels, sampwidth, framerate, nframes, comptype, compname = wr.getparams()
-    return nchannels
+    return getParams(sound_file)[0]
 
 def plotSoundWave(rate, sample):
     """
         Plots a given sound wave.
     """
 
-    t = scipy.linspace(0, 2, 2*rate, endpoint=False)
+    t = numpy.linspace(0, 2, 2*rate, endpoint=False)
     pylab.figure('Sound wave')
     T = int(0.0001*rate)
     pylab.plot(t[:T], sample[:T],)
@@ -89,7 +98,7 @@ def plotPowerSpectrum(FFT, binFrequencies, maxFreq):
 
     T = int(maxFreq)
     pylab.figure('Power spectrum')
-    pylab.plot(binFrequencies[:T], scipy.absolute(FFT[:T]) * scipy.absolute(FFT[:T]),)
+    pylab.plot(binFrequencies[:T], numpy.absolute(FFT[:T]) * numpy.absolute(FFT[:T]),)
     pylab.xlabel('Frequency (Hz)')
     pylab.ylabel('Power spectrum (|X[k]|^2)')
     pylab.show()
@@ -118,13 +127,107 @@ def get_next_power_2(n):
         return 1
 
 
+# Consider only segments with a duration longer than 0.18 seconds.
+MIN_NOTE_DURATION = 0.18
+
+
+def get_next_power_2_up(n):
+    """
+        Returns the smallest power of 2 that is not smaller than n.
+    """
+
+    power = 1
+    while (power < n):
+        power *= 2
+    return power
+
+
+# FFT sizing strategies:
+#   'truncate' - largest power of 2 below the segment length (drops the rest
+#                of the segment, up to half of it)
+#   'pad'      - zero-pad to the next power of 2
+#   'fast'     - zero-pad to the next 5-smooth length (2^a 3^b 5^c)
+FFT_SIZING = ('truncate', 'pad', 'fast')
+
+
+def get_fft_length(duration, framerate, fft_sizing='truncate'):
+    """
+        Returns the FFT length used for a segment.
+    """
+
+    fft_length = int(duration * framerate)
+    if fft_sizing == 'truncate':
+        # For the FFT to work much faster take the length that is a power of 2.
+        return int(get_next_power_2(fft_length))
+    if fft_sizing == 'pad':
+        return get_next_power_2_up(fft_length)
+    if fft_sizing == 'fast':
+        return next_fast_len(max(fft_length, 1), real=True)
+    raise ValueError('Unknown FFT sizing strategy: %s' % (fft_sizing,))
+
+
+def get_mono_samples(segment, dtype=ANALYSIS_DTYPE):
+    """
+        Returns the samples of an AudioSegment as dtype, averaging the
+        channels of a stereo one.
+    """
+
+    sample = numpy.asarray(segment.samples, dtype=dtype)
+    if segment.nchannels > 1:
+        sample = sample.mean(axis=1)
+    return sample
+
+
+def detect_MIDI_notes_batch(segments, max_batch_bytes=2 ** 26, fft_sizing='truncate', dtype=ANALYSIS_DTYPE):
+    """
+        Detects the MIDI notes of all onset segments of a recording at once.
+        Segments are grouped by FFT length and every group is transformed
+        with one stacked rfft call (split into batches of at most
+        max_batch_bytes of dtype samples). fft_sizing is one of FFT_SIZING.
+        Returns the list of MIDI notes of each segment and the array of
+        segment durations, as MIDI_Detector would per segment.
+    """
+
+    segments = [as_segment(s) for s in segments]
+    durations = numpy.array([s.duration for s in segments])
+    midi_notes = [[] for s in segments]
+    detector = MIDI_Detector(None, fft_sizing, dtype)
+
+    groups = {}
+    for i, segment in enumerate(segments):
+        if durations[i] > MIN_NOTE_DURATION:
+            key = (get_fft_length(durations[i], segment.framerate, fft_sizing), segment.framerate)
+            groups.setdefault(key, []).append(i)
+
+    for (fft_length, framerate), indices in groups.items():
+        rows = max(1, max_batch_bytes // (numpy.dtype(dtype).itemsize * fft_length))
+        for start in range(0, len(indices), rows):
+            batch = indices[start:start + rows]
+            # rfft(sample, n) truncates or zero-pads every row to fft_length.
+            stack = numpy.zeros((len(batch), fft_length), dtype=dtype)
+            for row, i in enumerate(batch):
+                sample = get_mono_samples(segments[i], dtype)[:fft_length]
+                stack[row, :len(sample)] = sample
+            FFTs = numpy.fft.rfft(stack, axis=1)
+            for row, i in enumerate(batch):
+                FFT, filteredFreqs, maxFreq, magnitudes, significant_freq = detector.analyzeFFT(
+                    FFTs[row], fft_length, framerate, durations[i])
+                midi_notes[i] = detector.getMIDINotes(filteredFreqs)
+    return midi_notes, durations
+
+
 class MIDI_Detector(object):
     """
-        Class for MIDI notes detection given a .wav file.
+        Class for MIDI notes detection given a .wav file or an AudioSegment.
     """
 
-    def __init__(self, wav_file):
+    def __init__(self, wav_file, fft_sizing='truncate', dtype=ANALYSIS_DTYPE):
+        # A .wav file path or an AudioSegment.
         self.wav_file = wav_file
+        # How segment lengths are turned into FFT sizes, see FFT_SIZING.
+        self.fft_sizing = fft_sizing
+        # Precision of the samples and spectra, see dtypes.py.
+        self.dtype = dtype
         self.minFreqConsidered = 20
         self.maxFreqConsidered = 5000
         self.low_f0s = [27.5, 29.135, 30.868, 32.703, 34.648, 37.708, 38.891,
@@ -136,20 +239,17 @@ class MIDI_Detector(object):
             The algorithm for calculating midi notes from a given wav file.
         """
 
-        (framerate, sample) = wav.read(self.wav_file)
-        if get_channels_no(self.wav_file) > 1:
-            sample = sample.mean(axis=1)
-        duration = getDuration(self.wav_file)
+        # A file path is read once into an AudioSegment.
+        segment = as_segment(self.wav_file)
+        framerate, sample = segment.framerate, get_mono_samples(segment, self.dtype)
+        duration = segment.duration
         midi_notes = []
 
         # Consider only files with a duration longer than 0.18 seconds.
-        if duration > 0.18:
+        if duration > MIN_NOTE_DURATION:
             FFT, filteredFreqs, maxFreq, magnitudes, significant_freq = self.calculateFFT(duration, framerate, sample)
             #plotPowerSpectrum(FFT, filteredFreqs, 1000)
-            clusters = self.clusterFrequencies(filteredFreqs)
-            averagedClusters = self.getClustersMeans(clusters)
-            f0_candidates = self.getF0Candidates(averagedClusters)
-            midi_notes = self.matchWithMIDINotes(f0_candidates)
+            midi_notes = self.getMIDINotes(filteredFreqs)
 
             '''
             OCTAVE CORRECTION METHOD
@@ -174,6 +274,17 @@ class MIDI_Detector(object):
 
         return midi_notes, duration
 
+    def getMIDINotes(self, filteredFreqs):
+        """
+            Clusters the significant frequencies of a spectrum and matches
+            the F0 candidates with MIDI notes.
+        """
+
+        clusters = self.clusterFrequencies(filteredFreqs)
+        averagedClusters = self.getClustersMeans(clusters)
+        f0_candidates = self.getF0Candidates(averagedClusters)
+        return self.matchWithMIDINotes(f0_candidates)
+
     def remove_lower_octave(self, upper_octave, midi_notes):
         lower_octave = upper_octave - 12
         if lower_octave in midi_notes:
@@ -204,48 +315,46 @@ class MIDI_Detector(object):
             a given threshold.
         """
 
-        fft_length = int(duration * framerate)
-        # For the FFT to work much faster take the length that is a power of 2.
-        fft_length = get_next_power_2(fft_length)
-        FFT = numpy.fft.fft(sample, n=int(fft_length))  # !!! int(fft_length)
+        fft_length = get_fft_length(duration, framerate, self.fft_sizing)
+        FFT = numpy.fft.rfft(numpy.asarray(sample, dtype=self.dtype), n=fft_length)
+        return self.analyzeFFT(FFT, fft_length, framerate, duration)
+
+    def analyzeFFT(self, FFT, fft_length, framerate, duration):
+        """
+            Given the rfft of a sound wave finds the frequencies with the
+            magnitudes higher than a given threshold.
+        """
 
         ''' ADJUSTING THRESHOLD - HIGHEST SPECTRAL PEAK METHOD'''
-        threshold = 0
-        power_spectra = []
+        power_spectra = abs(FFT[:int(fft_length) // 2]) ** 2
         frequency_bin_with_max_spectrum = 0
-        for i in range(len(FFT) // 2):
-            power_spectrum = scipy.absolute(FFT[i]) * scipy.absolute(FFT[i])
-            if power_spectrum > threshold:
-                threshold = power_spectrum
-                frequency_bin_with_max_spectrum = i
-            power_spectra.append(power_spectrum)
-        max_power_spectrum = threshold
-        threshold *= 0.1
-
-        binFrequencies = []
-        magnitudes = []
-        binResolution = float(framerate) / float(fft_length)
-        sum_of_significant_spectra = 0
+        max_power_spectrum = 0
+        if len(power_spectra) > 0:
+            frequency_bin_with_max_spectrum = int(numpy.argmax(power_spectra))
+            max_power_spectrum = power_spectra[frequency_bin_with_max_spectrum]
+        threshold = max_power_spectrum * 0.1
+
         # For each bin calculate the corresponding frequency.
-        for k in range(len(FFT)):
-            binFreq = k * binResolution
-
-            # Truncating the FFT so we consider only hearable frequencies.
-            if binFreq > self.maxFreqConsidered:
-                FFT = FFT[:k]
-                break
-            elif binFreq > self.minFreqConsidered:
-                # Consider only the frequencies
-                # with magnitudes higher than the threshold.
-                power_spectrum = power_spectra[k]
-                if power_spectrum > threshold:
-                    magnitudes.append(power_spectrum)
-                    binFrequencies.append(binFreq)
-
-                    # Sum all significant power spectra
-                    # except the max power spectrum.
-                    if power_spectrum != max_power_spectrum:
-                        sum_of_significant_spectra += power_spectrum
+        binResolution = float(framerate) / float(fft_length)
+        binFreqs = numpy.arange(len(FFT)) * binResolution
+
+        # Truncating the FFT so we consider only hearable frequencies.
+        above_max = numpy.flatnonzero(binFreqs > self.maxFreqConsidered)
+        if len(above_max) > 0:
+            FFT = FFT[:above_max[0]]
+        n = min(len(FFT), len(power_spectra))
+
+        # Consider only the frequencies
+        # with magnitudes higher than the threshold.
+        significant = (binFreqs[:n] > self.minFreqConsidered) & (power_spectra[:n] > threshold)
+        binFrequencies = binFreqs[:n][significant]
+        magnitudes = power_spectra[:n][significant]
+
+        # Sum all significant power spectra
+        # except the max power spectrum.
+        # cumsum adds in order, matching a running Python sum bit for bit.
+        others = magnitudes[magnitudes != max_power_spectrum]
+        sum_of_significant_spectra = numpy.cumsum(others)[-1] if len(others) > 0 else 0
 
         significant_freq = 0.0
 
@@ -284,7 +393,7 @@ class MIDI_Detector(object):
 
         # Plot the magnitude spectrogram.
         pylab.figure('Magnitude spectrogram')
-        pylab.imshow(scipy.absolute(X.T), origin='lower', aspect='auto',
+        pylab.imshow(numpy.absolute(X.T), origin='lower', aspect='auto',
                      interpolation='nearest')
         pylab.xlabel('Time')
         pylab.ylabel('Frequency')
@@ -298,7 +407,7 @@ class MIDI_Detector(object):
 
         significantFreqs = []
         for i in range(len(FFT)):
-            power_spectrum = scipy.absolute(FFT[i]) * scipy.absolute(FFT[i])
+            power_spectrum = numpy.absolute(FFT[i]) * numpy.absolute(FFT[i])
             if power_spectrum > threshold:
                 significantFreqs.append(i / duration)
 
@@ -306,33 +415,24 @@ class MIDI_Detector(object):
 
     def clusterFrequencies(self, freqs):
         """
-            Clusters frequencies.
+            Clusters sorted frequencies: a new cluster starts wherever the
+            distance (see calcDistance) to the previous frequency is 2 or more.
+            Returns a list of arrays.
         """
 
+        freqs = numpy.asarray(freqs, dtype=float)
         if len(freqs) == 0:
-            return {}
-        clusteredFreqs = {}
-        bin = 0
-        clusteredFreqs[0] = [freqs[0]]
-        for i in range(len(freqs) - 1):
-            dist = self.calcDistance(freqs[i], freqs[i + 1])
-            if dist < 2.0:
-                clusteredFreqs[bin].append(freqs[i + 1])
-            else:
-                bin += 1
-                clusteredFreqs[bin] = [freqs[i + 1]]
-
-        return clusteredFreqs
+            return []
+        dist = abs(numpy.diff(freqs)) / numpy.log((freqs[:-1] + freqs[1:]) / 2)
+        return numpy.split(freqs, numpy.flatnonzero(~(dist < 2.0)) + 1)
 
     def getClustersMeans(self, clusters):
         """
             Given clustered frequencies finds a mean of each cluster.
         """
 
-        means = []
-        for bin, freqs in clusters.items():
-            means.append(sum(freqs) / len(freqs))
-        return means
+        # cumsum adds in order, matching sum() bit for bit.
+        return numpy.array([numpy.cumsum(freqs)[-1] / len(freqs) for freqs in clusters])
 
     def getDistances(self, freqs):
         """
@@ -378,10 +478,9 @@ class MIDI_Detector(object):
         while len(frequencies) > 0:
             f0_candidate = frequencies[0]
             f0_candidates.append(f0_candidate)
-            frequencies.remove(f0_candidate)
-            frequencies = self.filterOutHarmonics(frequencies, f0_candidate)
+            frequencies = self.filterOutHarmonics(frequencies[1:], f0_candidate)
             break
-        return f0_candidates
+        return numpy.array(f0_candidates)
 
     def filterOutHarmonics(self, frequencies, f0_candidate):
         """
@@ -393,10 +492,9 @@ class MIDI_Detector(object):
         # then it is its harmonic. This constant was found empirically.
         REMAINDER_THRESHOLD = 0.2
 
-        def is_multiple(f, f0):
-            return abs(round(f / f0) - f / f0) < REMAINDER_THRESHOLD
-
-        return [f for f in frequencies if not is_multiple(f, f0_candidate)]
+        frequencies = numpy.asarray(frequencies)
+        ratios = frequencies / f0_candidate
+        return frequencies[~(abs(numpy.round(ratios) - ratios) < REMAINDER_THRESHOLD)]
 
     def find_low_freq_candidate(self, frequencies):
         REMAINDER_THRESHOLD = 0.05
@@ -437,12 +535,10 @@ class MIDI_Detector(object):
         return (partials, partial_magnitudes)
 
     def matchWithMIDINotes(self, f0_candidates):
-        midi_notes = []
-        for freq in f0_candidates:
-            # Formula for calculating MIDI note number.
-            midi_notes.append(int(
-                round(69 + 12 * math.log(freq / 440) / math.log(2))))
-        return midi_notes
+        f0_candidates = numpy.asarray(f0_candidates, dtype=float)
+        # Formula for calculating MIDI note number.
+        midi_notes = numpy.rint(69 + 12 * numpy.log(f0_candidates / 440) / math.log(2))
+        return midi_notes.astype(int).tolist()
 
 if __name__ == '__main__':
     # MIDI_detector = MIDI_Detector(sys.argv[1])
@@ -1,15 +1,29 @@
 import sys
 import os
+import wave
+import numpy as np
 curPath = os.path.abspath(os.path.dirname(__file__))
 
 sys.path.append(curPath)
 
 from melody_note.work.wav_note.onset_frames_split import OnsetFrameSplitter
 #from first_peaks_method import MIDI_Detector
-from melody_note.work.wav_note.plotNotes import NotePlotter
+from melody_note.work.wav_note.plotNotes import NOTE_PDF_DIR, NotePlotter
+from melody_note.work.wav_note.workspace import JobWorkspace
+from melody_note.work.wav_note import yin_method
+from melody_note.work.wav_note.shared_spectrum import SharedSpectrum
+from melody_note.work.wav_note.speech_enhance import write_wav
+from melody_note.work.wav_note.resample import DEFAULT_QUALITY, decimate
+from melody_note.work.wav_note.audio_segment import AudioSegment
+from melody_note.work.wav_note.first_peaks_method import get_mono_samples
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE
+from melody_note.work.wav_note.stage_cache import MISSING, file_digest, stage_key
 #from highest_peak_method import Highest_Peaks_MIDI_Detector
 import os
 
+# Stages of transcribe(), in order, as reported to the progress callback.
+STAGES = ('decimate', 'split', 'plot')
+
 
 class MusicTranscriber(object):
     """
@@ -17,25 +31,179 @@ class MusicTranscriber(object):
         to pdf sheet notes.
     """
 
-    def __init__(self, music_file):
+    def __init__(self, music_file, save_no_noise=False, onset_frames_dir=None, fft_sizing='truncate',
+                 pitch_engine='first_peaks', analysis_rate=None, resample_quality=DEFAULT_QUALITY,
+                 trim_silence=False, output_dir=NOTE_PDF_DIR, progress=None, stage_cache=None,
+                 render_cache=None, engraver=None, save_analysis=False):
         self.music_file = music_file
-        self.onset_frames_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'frames')
+        self.save_no_noise = save_no_noise
+        # Onset frames are passed in memory; set a directory (e.g. 'frames')
+        # to also dump them as note%d.wav for debugging.
+        self.onset_frames_dir = onset_frames_dir
+        # FFT sizing strategy of the pitch detector: 'truncate', 'pad' or 'fast'.
+        self.fft_sizing = fft_sizing
+        # Pitch engine: 'first_peaks' or 'piano_key' (per onset segment),
+        # 'yin' (frame-level f0 tracking, no onset split) or 'shared_stft'
+        # (onsets and pitch from the denoiser's spectrogram).
+        self.pitch_engine = pitch_engine
+        # Frame rate (Hz) the analysis stages run at, e.g. 11025. The
+        # recording is decimated once, in memory; None analyses at the
+        # recording's own rate.
+        self.analysis_rate = analysis_rate
+        # Also write the decimated signal next to the music file as
+        # _analysis.wav (debug only).
+        self.save_analysis = save_analysis
+        # Resampler: 'soxr' (default) or a polyphase profile 'fast',
+        # 'balanced' or 'high'.
+        self.resample_quality = resample_quality
+        # Skip the silences found by the energy VAD (onset split engines).
+        self.trim_silence = trim_silence
+        # Directory the .pdf/.mid of the score are published to.
+        self.output_dir = output_dir
+        # Called with the name of every stage (see STAGES) as it starts.
+        self.progress = progress
+        # StageCache of the stage results (stage_cache.py); None recomputes
+        # everything.
+        self.stage_cache = stage_cache
+        # RenderCache of the LilyPond output (render_cache.py); None runs
+        # LilyPond for every score.
+        self.render_cache = render_cache
+        # BatchEngraver (engraver.py) the score is engraved by, batched with
+        # other jobs; None runs LilyPond in this process.
+        self.engraver = engraver
+
+    def report(self, stage):
+        if self.progress is not None:
+            self.progress(stage)
+
+    def caching(self):
+        # 调试输出（降采样后、降噪后的 wav，分段 wav）只在实际计算时产生，调试时不使用缓存
+        return (self.stage_cache is not None and not self.save_no_noise and not self.save_analysis
+                and self.onset_frames_dir is None)
+
+    def cached(self, stage, key, compute):
+        """
+            The result of a stage from the stage cache, compute() on a miss
+            or when not caching.
+        """
+
+        if not self.caching():
+            return compute()
+        return self.stage_cache.fetch(stage, key, compute)
+
+    def analysis_recording(self):
+        """
+            The AudioSegment the analysis stages read: the mapped music
+            file, or its decimation to analysis_rate, kept in memory.
+        """
+
+        recording = AudioSegment.from_file(self.music_file)
+        if self.analysis_rate is None:
+            return recording
+        self.report('decimate')
+        recording = decimate(recording, self.analysis_rate, self.resample_quality)
+        print ('Decimated the music file for analysis')
+        if self.save_analysis:
+            with wave.open(self.music_file.split('.')[0] + '_analysis.wav', 'wb') as w:
+                w.setparams((recording.nchannels, 2, recording.framerate, recording.length,
+                             'NONE', 'not compressed'))
+                w.writeframes(recording.tobytes())
+        return recording
+
+    def splitter(self):
+        splitter = OnsetFrameSplitter(self.music_file, self.onset_frames_dir, self.save_no_noise,
+                                      self.resample_quality, self.trim_silence, recording=self.analysis_recording())
+        # The debug artifact goes next to the original file.
+        splitter.music_file_no_noice = self.music_file.split('.')[0] + '_no_noise.wav'
+        print ('Created onset frame splitter object')
+        return splitter
 
     def transcribe(self):
         """
             Splits the music file to be transcribed into onset frames,
             detects the notes in each frame and plots them on the staff.
+            Every call works in its own scratch directory, so several
+            transcriptions can run in parallel.
+
+            With a stage_cache, every stage is looked up by a key derived
+            from the audio digest and the parameters of the stages up to it,
+            and only the stages after the last hit run; a repeated request
+            only republishes the cached score.
         """
         print("1:" + os.path.abspath(os.path.dirname(__file__)))
         print("2:" + os.path.dirname(__file__))
-        splitter = OnsetFrameSplitter(self.music_file, self.onset_frames_dir)
-        print ('Created onset frame splitter object')
-        splitter.onset_frames_split()
-        print ('Splitted the file into frames')
-        note_plotter = NotePlotter(self.music_file)
-        print ('Created a note plotter object')
-        notes, durations = note_plotter.plot_multiple_notes(self.onset_frames_dir)
-        print ('Plotted multiple notes')
+        audio = file_digest(self.music_file) if self.caching() else None
+        dtype = np.dtype(ANALYSIS_DTYPE).str
+        with JobWorkspace() as workspace:
+            note_plotter = NotePlotter(self.music_file, workspace, self.output_dir, fft_sizing=self.fft_sizing,
+                                       pitch_engine=self.pitch_engine, render_cache=self.render_cache,
+                                       engraver=self.engraver)
+            print ('Created a note plotter object')
+            self.report('split')
+            if self.pitch_engine == 'shared_stft':
+                detect_key = stage_key(audio, 'detect', self.pitch_engine, self.analysis_rate,
+                                       self.resample_quality, dtype)
+
+                def detect():
+                    splitter = self.splitter()
+                    params, recording = splitter.open()
+                    spectrum = SharedSpectrum(get_mono_samples(recording), params.framerate)
+                    if self.save_no_noise:
+                        write_wav(splitter.music_file_no_noice, params._replace(nchannels=1), spectrum.signal)
+                    print ('Detected the notes from the shared spectrogram')
+                    return spectrum.detect_MIDI_notes()
+            else:
+                # yin 不做端点检测，总是对整段录音降噪
+                trimmed = self.trim_silence and self.pitch_engine != 'yin'
+                denoise_key = stage_key(audio, 'denoise', self.analysis_rate, self.resample_quality, dtype, trimmed)
+
+                def denoised(splitter, recording=None):
+                    return self.cached('denoise', denoise_key, lambda: splitter.denoised_signal(recording))
+
+                if self.pitch_engine == 'yin':
+                    detect_key = stage_key(denoise_key, 'detect', self.pitch_engine)
+
+                    def detect():
+                        y, sr = denoised(self.splitter())
+                        print ('Tracked the pitch of the denoised signal')
+                        return yin_method.detect_notes(y, sr)
+                else:
+                    onset_key = stage_key(denoise_key, 'onsets')
+                    detect_key = stage_key(onset_key, 'detect', self.pitch_engine, self.fft_sizing)
+
+                    def detect():
+                        splitter = self.splitter()
+                        detect_onsets = lambda recording: self.cached(
+                            'onsets', onset_key,
+                            lambda: splitter.detect_onsets(recording, denoised(splitter, recording)))
+                        segments = splitter.onset_frames_split(detect_onsets)
+                        print ('Splitted the file into frames')
+                        return note_plotter.detect_notes(segments)
+
+            score_key = stage_key(detect_key, 'score')
+            score = self.stage_cache.get('score', score_key) if self.caching() else MISSING
+            if score is not MISSING:
+                self.report('plot')
+                note_plotter.restore_score(score['files'])
+                print ('Published the cached score')
+                return score['notes'], score['durations']
+            detection = self.cached('detect', detect_key, detect)
+
+            self.report('plot')
+            if self.pitch_engine == 'yin':
+                notes, durations = note_plotter.plot_midi_notes(*detection)
+            else:
+                notes, durations = note_plotter.plot_segment_notes(*detection)
+            print ('Plotted multiple notes')
+            if self.caching():
+                files = {}
+                for ext, path in note_plotter.score_files().items():
+                    if os.path.exists(path):
+                        with open(path, 'rb') as f:
+                            files[ext] = f.read()
+                # LilyPond 失败时不缓存，下次重新打谱
+                if '.pdf' in files:
+                    self.stage_cache.put(score_key, {'notes': notes, 'durations': durations, 'files': files})
         return notes, durations
 
 
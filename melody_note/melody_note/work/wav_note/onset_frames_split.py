@@ -2,7 +2,12 @@ import sys
 import wave
 import os
 import librosa
-from .speech_enhance import noise_reduction
+from .speech_enhance import denoise, denoise_samples, write_wav
+from .dtypes import ANALYSIS_DTYPE
+from .audio_segment import AudioSegment
+from .wav_reader import WavParams, open_wav
+from .resample import DEFAULT_QUALITY, resample
+from .vad import TrimmedRecording, voiced_spans
 import shutil
 
 
@@ -11,17 +16,94 @@ class OnsetFrameSplitter(object):
         A class for splitting a file into onset frames.
     """
 
-    def __init__(self, music_file, output_directory):
+    # librosa.load 的默认采样率
+    ONSET_SAMPLE_RATE = 22050
+
+    def __init__(self, music_file, output_directory=None, save_no_noise=False,
+                 resample_quality=DEFAULT_QUALITY, trim_silence=False, dtype=ANALYSIS_DTYPE, recording=None):
         self.music_file = music_file
+        # AudioSegment analysed instead of the music file's samples, e.g.
+        # its decimation to the analysis rate (resample.decimate).
+        self.recording = recording
         self.music_file_no_noice = music_file.split('.')[0]+'_no_noise.wav'
+        # Write the onset segments to output_directory (debug only).
         self.output_directory = output_directory
+        # Write the denoised signal to music_file_no_noice (debug only).
+        self.save_no_noise = save_no_noise
+        # Resampler to ONSET_SAMPLE_RATE: 'soxr' or a polyphase profile, see
+        # resample.QUALITIES.
+        self.resample_quality = resample_quality
+        # Only analyse the voiced spans found by the energy VAD (vad.py).
+        self.trim_silence = trim_silence
+        # Precision of the denoising and onset analysis, see dtypes.py.
+        self.dtype = dtype
         self.verbose = False
 
-    def onset_frames_split(self):
+    def denoised_signal(self, recording=None):
+        """
+            Denoises the recording (or the given AudioSegment) in memory
+            and returns the signal the
+            way librosa.load would read it back from the _no_noise.wav file:
+            mono self.dtype samples in [-1, 1), resampled to
+            ONSET_SAMPLE_RATE. The
+            resampling uses resample_quality: soxr, as librosa does, or a
+            cached polyphase filter.
+        """
+
+        if recording is None:
+            recording = self.recording
+        if recording is None:
+            params, wave_data = denoise(self.music_file, dtype=self.dtype)
+        else:
+            params = WavParams(recording.nchannels, 2, recording.framerate, recording.length,
+                               'NONE', 'not compressed')
+            wave_data = denoise_samples(recording.buffer[recording.offset:recording.offset + recording.length].ravel(),
+                                        recording.framerate, dtype=self.dtype)
+        if self.save_no_noise:
+            write_wav(self.music_file_no_noice, params, wave_data)
+        nchannels, sampwidth, framerate = params[:3]
+        y = wave_data.astype(self.dtype) / 32768
+        if nchannels > 1:
+            y = y[:len(y) // nchannels * nchannels].reshape(-1, nchannels).mean(axis=1)
+        y = resample(y, framerate, self.ONSET_SAMPLE_RATE, self.resample_quality, self.dtype)
+        return y, self.ONSET_SAMPLE_RATE
+
+    def open(self):
+        """
+            Returns the params and the AudioSegment of the recording to
+            split: self.recording if given, else the mapped music file.
+        """
+
+        if self.recording is None:
+            params, data = open_wav(self.music_file)
+            return params, AudioSegment(data, params.framerate)
+        recording = self.recording
+        params = WavParams(recording.nchannels, 2, recording.framerate, recording.length,
+                           'NONE', 'not compressed')
+        return params, recording
+
+    def detect_onsets(self, recording, signal=None):
         """
-            Splits a music file into onset frames.
+            Onset times (seconds) in recording, found in its denoised
+            signal (denoised_signal(recording) unless given).
+        """
+
+        y, sr = signal if signal is not None else self.denoised_signal(recording)
+        print('Executed noice reduction')
+        return librosa.onset.onset_detect(y=y, sr=sr, units='time')
+
+    def onset_frames_split(self, detect_onsets=None):
+        """
+            Splits a music file into onset frames. Returns a list of
+            AudioSegment views into the recording, one per onset.
+            detect_onsets(recording) replaces self.detect_onsets, e.g. to
+            look the onsets up in a StageCache.
         """
         print ('Just about to execute object frames split function')
+        if detect_onsets is None:
+            detect_onsets = self.detect_onsets
+        if self.trim_silence:
+            return self.voiced_frames_split(detect_onsets)
         onsets_output_file = "onsets.txt"
         #OD_METHOD = 'mkl'
 
@@ -34,23 +116,17 @@ class OnsetFrameSplitter(object):
         #         print( o)
         # print( 'Executed aubioonset function to split the file into onsets')
 
-        # noise reduction
-        noise_reduction(self.music_file, self.music_file_no_noice)
-        print('Executed noice reduction')
+        # Mapping the music wave and getting parameters.
+        params, recording = self.open()
+        nframes, framerate = params.nframes, params.framerate
 
-        # onset_detect
-        y, sr = librosa.load(self.music_file_no_noice)
-        onsets = librosa.onset.onset_detect(y=y,sr=sr, units='time')
+        # noise reduction, onset_detect
+        onsets = detect_onsets(recording)
         if self.verbose:
             print ('onsets: ')
             for o in onsets:
                 print(o)
         print('Executed librosa function to split the file into onsets')
-        # Reading in the music wave and getting parameters.
-        input_music_wave = wave.open(self.music_file, "rb")
-        nframes = input_music_wave.getnframes()
-        params = input_music_wave.getparams()
-        framerate = input_music_wave.getframerate()
         duration = nframes / float(framerate)
 
         if self.verbose:
@@ -62,23 +138,61 @@ class OnsetFrameSplitter(object):
         onsets.append(duration)
         onsets[0] = 0.0
 
+        print ('Just about to split the file into onset frames')
+        # Splitting the music file into onset frames.
+        segments = []
+        offset = 0
+        for i in range(len(onsets) - 1):
+            frame = int(framerate * (onsets[i + 1] - onsets[i]))
+            segments.append(recording.slice(offset, frame))
+            offset += frame
+        print ('Split the file into onset frames')
+
+        if self.output_directory is not None:
+            self.write_segments(segments, params)
+        return segments
+
+    def voiced_frames_split(self, detect_onsets=None):
+        """
+            onset_frames_split on the voiced spans only: silences found by
+            the VAD are cut out before denoising and onset detection, and
+            the onsets are mapped back to the recording. Segments never
+            extend into a silence.
+        """
+
+        params, recording = self.open()
+        trimmed = TrimmedRecording(recording, voiced_spans(recording))
+        print ('Trimmed %.2f of %.2f seconds of silence' % (
+            recording.duration - trimmed.trimmed.duration, recording.duration))
+        if trimmed.trimmed.length == 0:
+            return []
+
+        onsets = (detect_onsets or self.detect_onsets)(trimmed.trimmed)
+        segments = trimmed.split(onsets)
+        print ('Split the voiced spans into onset frames')
+
+        if self.output_directory is not None:
+            self.write_segments(segments, params)
+        return segments
+
+    def write_segments(self, segments, params):
+        """
+            Writes every onset segment to output_directory as note%d.wav
+            (debug only, the pipeline passes segments in memory).
+        """
+
         if not os.path.exists(self.output_directory):
             os.makedirs(self.output_directory)
         else:
             shutil.rmtree(self.output_directory)    # clear the directory
             os.mkdir(self.output_directory)
 
-        print ('Just about to split the file into onset frames')
-        # Splitting the music file into onset frames.
-        for i in range(len(onsets) - 1):
-            frame = int(framerate * (onsets[i + 1] - onsets[i]))
-            sound = input_music_wave.readframes(frame)
+        for i, segment in enumerate(segments):
             music_wave = wave.open(self.output_directory + "/note%d.wav" % (i, ), "wb")
             music_wave.setparams(params)
-            music_wave.setnframes(frame)
-            music_wave.writeframes(sound)
+            music_wave.setnframes(segment.length)
+            music_wave.writeframes(segment.tobytes())
             music_wave.close()
-        print ('Split the file into onset frames')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,150 @@
+import functools
+import numpy
+from scipy import sparse
+from melody_note.work.wav_note.audio_segment import as_segment
+from melody_note.work.wav_note.first_peaks_method import MIN_NOTE_DURATION, get_mono_samples
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE, complex_dtype
+
+# The 88 piano keys, as in NotePlotter.number2note.
+LOWEST_KEY = 21
+HIGHEST_KEY = 108
+KEYS = numpy.arange(LOWEST_KEY, HIGHEST_KEY + 1)
+
+# Spectral kernel entries below this magnitude are dropped (Brown & Puckette).
+KERNEL_THRESHOLD = 0.0054
+
+# Harmonics summed into a key's salience: semitone offsets of harmonics 1-5
+# and their weights.
+HARMONIC_OFFSETS = numpy.array([0, 12, 19, 24, 28])
+HARMONIC_WEIGHTS = 0.8 ** numpy.arange(len(HARMONIC_OFFSETS))
+
+# At most this many analysis frames are taken from a segment.
+MAX_FRAMES = 8
+
+
+def key_frequency(key):
+    return 440.0 * 2 ** ((key - 69) / 12.0)
+
+
+@functools.lru_cache(maxsize=None)
+def piano_key_kernel(framerate, dtype=ANALYSIS_DTYPE):
+    """
+        Returns the sparse spectral kernel of a filterbank centred on the 88
+        piano keys at a given frame rate, and its frame length. Every row
+        holds the conjugated spectrum of a Hamming-windowed complex
+        exponential at the key's frequency, so the key salience of a frame
+        is a single sparse matrix product with the frame's rfft. The kernel
+        is built once per frame rate (and dtype of the frames it is applied
+        to) and shared by all segments and requests.
+
+        All keys use the full frame: constant-Q windows (shorter for high
+        keys) let onset transients dominate the upper keys on real
+        recordings, while a fixed quarter-second window keeps every key's
+        filter a few bins wide.
+    """
+
+    # About a quarter of a second.
+    frame_length = 1
+    while frame_length < framerate // 4:
+        frame_length *= 2
+    window = numpy.hamming(frame_length) / frame_length
+    n = numpy.arange(frame_length)
+    kernel = numpy.zeros((len(KEYS), frame_length // 2 + 1), dtype=complex)
+    for row, key in enumerate(KEYS):
+        temporal = window * numpy.exp(2j * numpy.pi * key_frequency(key) * n / framerate)
+        spectral = numpy.fft.fft(temporal)[:frame_length // 2 + 1]
+        spectral[abs(spectral) < KERNEL_THRESHOLD] = 0
+        kernel[row] = numpy.conj(spectral) / frame_length
+    return sparse.csr_matrix(kernel.astype(complex_dtype(dtype))), frame_length
+
+
+def segment_frames(sample, frame_length):
+    """
+        Returns up to MAX_FRAMES evenly spaced, non-overlapping frames of a
+        segment (a single zero-padded frame for short segments), in the
+        dtype of the samples.
+    """
+
+    if len(sample) <= frame_length:
+        frame = numpy.zeros(frame_length, dtype=sample.dtype)
+        frame[:len(sample)] = sample
+        return frame[numpy.newaxis]
+    starts = numpy.linspace(0, len(sample) - frame_length,
+                            min(MAX_FRAMES, len(sample) // frame_length)).astype(int)
+    return numpy.array([sample[s:s + frame_length] for s in starts])
+
+
+def salience_to_notes(salience):
+    """
+        Picks the key whose harmonics carry the most energy.
+    """
+
+    summed = numpy.zeros(len(KEYS))
+    for offset, weight in zip(HARMONIC_OFFSETS, HARMONIC_WEIGHTS):
+        summed[:len(KEYS) - offset] += weight * salience[offset:]
+    if not summed.any():
+        return []
+    return [int(KEYS[numpy.argmax(summed)])]
+
+
+def detect_MIDI_notes_batch(segments, max_batch_bytes=2 ** 26, dtype=ANALYSIS_DTYPE):
+    """
+        Detects the MIDI notes of all onset segments of a recording. The
+        frames of the segments with the same frame rate go through one
+        rfft call and one sparse product with the cached key kernel, in
+        dtype (split into batches of whole segments of at most
+        max_batch_bytes of dtype frames, like
+        first_peaks_method.detect_MIDI_notes_batch). Returns the same
+        (notes per segment, durations).
+    """
+
+    segments = [as_segment(s) for s in segments]
+    durations = numpy.array([s.duration for s in segments])
+    midi_notes = [[] for s in segments]
+
+    groups = {}
+    for i, segment in enumerate(segments):
+        if durations[i] > MIN_NOTE_DURATION:
+            groups.setdefault(segment.framerate, []).append(i)
+
+    def detect(kernel, batch, frames):
+        spectra = numpy.fft.rfft(numpy.concatenate(frames), axis=1)
+        salience = abs(kernel @ spectra.T) ** 2
+        bounds = numpy.cumsum([0] + [len(f) for f in frames])
+        for j, i in enumerate(batch):
+            midi_notes[i] = salience_to_notes(salience[:, bounds[j]:bounds[j + 1]].mean(axis=1))
+
+    for framerate, indices in groups.items():
+        kernel, frame_length = piano_key_kernel(framerate, dtype)
+        # 每批最多的帧数；一个分段的帧总在同一批中
+        rows = max(MAX_FRAMES, max_batch_bytes // (numpy.dtype(dtype).itemsize * frame_length))
+        batch, frames, count = [], [], 0
+        for i in indices:
+            batch.append(i)
+            frames.append(segment_frames(get_mono_samples(segments[i], dtype), frame_length))
+            count += len(frames[-1])
+            if count + MAX_FRAMES > rows:
+                detect(kernel, batch, frames)
+                batch, frames, count = [], [], 0
+        if batch:
+            detect(kernel, batch, frames)
+    return midi_notes, durations
+
+
+class Piano_Key_MIDI_Detector(object):
+    """
+        MIDI notes detection with a filterbank centred on the 88 piano keys.
+        Same interface as first_peaks_method.MIDI_Detector.
+    """
+
+    def __init__(self, wav_file):
+        # A .wav file path or an AudioSegment.
+        self.wav_file = wav_file
+
+    def detect_MIDI_notes(self):
+        """
+            The algorithm for calculating midi notes from a given wav file.
+        """
+
+        notes, durations = detect_MIDI_notes_batch([self.wav_file])
+        return notes[0], durations[0]
@@ -1,22 +1,68 @@
-from .first_peaks_method import MIDI_Detector
+from .first_peaks_method import MIDI_Detector, detect_MIDI_notes_batch
+from . import piano_key_method
 #from least_squares_method import Highest_Peaks_MIDI_Detector
+from .workspace import JobWorkspace
+from .render_cache import link_or_copy
 import sys
 import os
+import subprocess
 import numpy as np
 #from least_squares_first_peaks_2 import MIDI_Detector_Least_Squares_2
 #from least_squares_highest_peaks_2 import Highest_Peaks_Least_Squares
 
 
+WAV_NOTE_DIR = os.path.dirname(os.path.abspath(__file__))
+LILYPOND = os.path.join(WAV_NOTE_DIR, 'LilyPond', 'usr', 'bin', 'lilypond.exe')
+NOTE_PDF_DIR = os.path.join(os.path.dirname(WAV_NOTE_DIR), 'note_pdf')
+
+# lilypond_version() 的结果，每个进程只运行一次 lilypond --version
+_lilypond_version = []
+
+
+def lilypond_version():
+    """
+        The first line of `lilypond --version` ("GNU LilyPond 2.18.2"),
+        None if LilyPond cannot be run.
+    """
+
+    if not _lilypond_version:
+        try:
+            output = subprocess.check_output([LILYPOND, '--version'], stderr=subprocess.STDOUT)
+            version = output.decode('utf-8', 'replace').strip().splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            version = None
+        _lilypond_version.append(version)
+    return _lilypond_version[0]
+
+
 class NotePlotter(object):
     """
         Class used for plotting sheet notes given MIDI note numbers.
     """
 
 
-    def __init__(self, wav_file):
+    def __init__(self, wav_file, workspace=None, output_dir=NOTE_PDF_DIR, fft_sizing='truncate',
+                 pitch_engine='first_peaks', render_cache=None, engraver=None):
         print ('Inside Note Plotter constructor')
         self.wav_file = wav_file
         self.output_file = wav_file[:-3] + 'ly'
+        # The .pdf and .mid are published to output_dir; LilyPond itself
+        # runs inside the job's private workspace (a temporary one if None).
+        self.workspace = workspace
+        self.output_dir = output_dir
+        # FFT sizing strategy of the pitch detector, see FFT_SIZING.
+        self.fft_sizing = fft_sizing
+        # 'first_peaks' (MIDI_Detector) or 'piano_key' (piano_key_method);
+        # 'yin' and 'shared_stft' do not split into segments, see
+        # MusicTranscriber.
+        self.pitch_engine = pitch_engine
+        # RenderCache (render_cache.py) of engraved scores; None always
+        # runs LilyPond.
+        self.render_cache = render_cache
+        # Engraving service (engraver.BatchEngraver or a proxy of one) that
+        # engraves the score together with those of other jobs; None runs
+        # LilyPond here.
+        self.engraver = engraver
         self.number2note = {
             21: 'a,,,',
             22: 'ais,,,',
@@ -151,41 +197,50 @@ class NotePlotter(object):
         os.system(command)
 
 
-    def plot_multiple_notes(self, directory):
+    def plot_multiple_notes(self, segments):
         """
             Plots notes using LilyPond library. The notes are on a left and righ
             hand staff (piano) and may be plotted as chords (multiple notes
             played simultaneously). The generated sheet notes are named after
-            the music file.
+            the music file. segments are the onset AudioSegments in time order.
         """
 
-        lilypond_text = '\\version \"2.14.2\" \n'
-        lilypond_text += '\\score { \n'
-        lilypond_text += '  \\new PianoStaff { \n'
-        lilypond_text += '    \\autochange { \n'
+        return self.plot_segment_notes(*self.detect_notes(segments))
+
+    def plot_segment_notes(self, segment_notes, segment_durations):
+        """
+            Plots the MIDI notes detected in every onset segment, given with
+            the segment durations (seconds).
+        """
 
-        numOfFiles = len(os.listdir(directory))
-        #for file_path in sorted(os.listdir(directory)):
         durations = []  # 每个音符的时长
         midi_notes = [] # 每个音符midi值
-        max_duration = 0
-        for i in range(numOfFiles):
-            file_path = 'note' + str(i) + '.wav'
-            detector = MIDI_Detector(directory + '/' + file_path)
-            midi_numbers, du = detector.detect_MIDI_notes()
-            print ('File: ' + str(file_path) + ' MIDI: ' + str(midi_numbers))
+        for i, (midi_numbers, du) in enumerate(zip(segment_notes, segment_durations)):
+            print ('Segment: ' + str(i) + ' MIDI: ' + str(midi_numbers))
             if len(midi_numbers) > 0:
                 # lilypond_text += ' < '
                 for n in midi_numbers:
                     if n in self.number2note.keys():
                         midi_notes.append(n)
                         durations.append(du)
-                        if du > max_duration:
-                            max_duration = du
-        durations = np.array(durations)
-        durations /= max_duration
                         # lilypond_text += self.number2note[n] + ' '
                 # lilypond_text += ' >'
+        return self.plot_midi_notes(midi_notes, durations)
+
+    def plot_midi_notes(self, midi_notes, durations):
+        """
+            Plots a sequence of MIDI notes with their durations (seconds) and
+            returns the notes and the durations relative to the longest one.
+        """
+
+        lilypond_text = '\\version \"2.14.2\" \n'
+        lilypond_text += '\\score { \n'
+        lilypond_text += '  \\new PianoStaff { \n'
+        lilypond_text += '    \\autochange { \n'
+
+        durations = np.array(durations, dtype=float)
+        if len(durations) > 0:
+            durations /= durations.max()
 
         for i in range(len(midi_notes)):
             lilypond_text += ' < '
@@ -193,23 +248,94 @@ class NotePlotter(object):
             lilypond_text += ' >'
         lilypond_text += '    \n}  \n}'
         lilypond_text += '\\layout { } \n \\midi { }  \n}'
-        with open(self.output_file, 'w') as f:
-            f.write(lilypond_text)
-        command = os.getcwd() + "\\melody_note\\work\\wav_note\\LilyPond\\usr\\bin\\lilypond.exe "
-        command += self.output_file
-        print (command)
-        os.system(command)
-        name = self.output_file.split('\\')[-1].split('.')[0]
-        #command = "move " + name + '.pdf examples\\' + name + '.pdf'
-        command = "move " + os.getcwd() +'\\' + name + '.pdf ' + os.getcwd() + '\\melody_note\\work\\note_pdf\\' + name + '.pdf'
-        os.system(command)
-        print(command)
-        #command = "move " + name + '.mid examples\\' + name + '.mid'
-        command = "move " + os.getcwd() +'\\' + name + '.mid ' + os.getcwd() + '\\melody_note\\work\\note_pdf\\' + name + '.mid'
-        os.system(command)
-        print(command)
+        if self.workspace is None:
+            with JobWorkspace() as workspace:
+                self.engrave(lilypond_text, workspace)
+        else:
+            self.engrave(lilypond_text, self.workspace)
         return midi_notes, durations
 
+    def detect_notes(self, segments):
+        """
+            Returns the MIDI notes of every segment and the segment durations
+            using the selected pitch engine.
+        """
+
+        if self.pitch_engine == 'first_peaks':
+            return detect_MIDI_notes_batch(segments, fft_sizing=self.fft_sizing)
+        if self.pitch_engine == 'piano_key':
+            return piano_key_method.detect_MIDI_notes_batch(segments)
+        raise ValueError('Unknown pitch engine: %s' % (self.pitch_engine,))
+
+    def engrave(self, lilypond_text, workspace):
+        """
+            Runs LilyPond on lilypond_text inside the workspace (or hands it
+            to the engraver) and publishes the .ly next to the wav file and
+            the .pdf/.mid to output_dir.
+        """
+
+        name = os.path.splitext(os.path.basename(self.output_file))[0]
+        ly_file = workspace.file(name + '.ly')
+        with open(ly_file, 'w') as f:
+            f.write(lilypond_text)
+        workspace.publish(name + '.ly', self.output_file)
+        # 同一 .ly 文本、同一 LilyPond 版本的乐谱直接从缓存链接过去，不启动 LilyPond
+        version = lilypond_version() if self.render_cache is not None else None
+        key = self.render_cache.key(lilypond_text, version) if version is not None else None
+        cached = self.render_cache.lookup(key) if key is not None else None
+        if cached is not None:
+            try:
+                for ext, path in cached.items():
+                    link_or_copy(path, os.path.join(self.output_dir, name + ext))
+            except FileNotFoundError:
+                # 缓存项刚被其他进程淘汰，当作未命中
+                print ('Render cache entry evicted, engraving the score')
+            else:
+                print ('LilyPond output found in the render cache')
+                return
+        destinations = dict((ext, os.path.join(self.output_dir, name + ext)) for ext in ('.pdf', '.mid'))
+        published = None
+        if self.engraver is not None:
+            try:
+                published = self.engraver.engrave(lilypond_text, destinations)
+            except (OSError, EOFError) as e:
+                # 打谱服务不可用时自己运行 LilyPond
+                print ('Engraving service unavailable: ' + str(e))
+        if published is None:
+            command = [LILYPOND, '-o', workspace.file(name), ly_file]
+            print (' '.join(command))
+            try:
+                subprocess.call(command, cwd=workspace.path)
+            except OSError as e:
+                print ('LilyPond failed: ' + str(e))
+            published = dict((ext, workspace.publish(name + ext, destination))
+                             for ext, destination in destinations.items()
+                             if os.path.exists(workspace.file(name + ext)))
+        if key is not None and '.pdf' in published:
+            self.render_cache.store(key, published)
+
+    def score_files(self):
+        """
+            The paths engrave publishes the score to, by extension.
+        """
+
+        name = os.path.splitext(os.path.basename(self.output_file))[0]
+        return {'.ly': self.output_file, '.pdf': os.path.join(self.output_dir, name + '.pdf'),
+                '.mid': os.path.join(self.output_dir, name + '.mid')}
+
+    def restore_score(self, contents):
+        """
+            Publishes a previously engraved score, given the contents of its
+            files by extension, to the paths of score_files.
+        """
+
+        paths = self.score_files()
+        with JobWorkspace() as workspace:
+            for ext, data in contents.items():
+                with open(workspace.file('score' + ext), 'wb') as f:
+                    f.write(data)
+                workspace.publish('score' + ext, paths[ext])
+
 if __name__ == '__main__':
     wav_file = sys.argv[1]
     note_plotter = NotePlotter(wav_file)
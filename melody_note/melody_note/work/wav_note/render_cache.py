@@ -0,0 +1,146 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+WAV_NOTE_DIR = os.path.dirname(os.path.abspath(__file__))
+RENDER_CACHE_DIR = os.path.join(os.path.dirname(WAV_NOTE_DIR), 'render_cache')
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+# LilyPond 的输出
+EXTENSIONS = ('.pdf', '.mid')
+
+
+def link_or_copy(source, destination):
+    """
+        Publishes source at destination as a hard link (a copy across file
+        systems), written under a temporary name and renamed like
+        JobWorkspace.publish. Readers and later publishes always replace
+        the destination, never write into it, so the cached file is safe.
+    """
+
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, '.%s.%s' % (os.path.basename(destination), os.urandom(4).hex()))
+    try:
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, destination)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return destination
+
+
+class RenderCache(object):
+    """
+        LilyPond output (.pdf and .mid) on local disk, keyed by a digest of
+        the exact .ly text and the LilyPond version: an entry is the
+        directory <key>/ holding score.pdf and score.mid. A hit is published
+        by hard-linking the cached files, without starting LilyPond.
+        Entries are touched when used and the least recently used ones are
+        removed once the cache holds more than max_bytes.
+    """
+
+    # StageCache.stats() 格式中的阶段名
+    STAGE = 'lilypond'
+
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(lilypond_text, version):
+        h = hashlib.sha256()
+        h.update(version.encode('utf-8') + b'\0')
+        h.update(lilypond_text.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        """
+            The cached files of key by extension, None on a miss. Every
+            extension LilyPond produced is there: entries are renamed into
+            place complete.
+        """
+
+        entry = self.path(key)
+        files = dict((ext, os.path.join(entry, 'score' + ext)) for ext in EXTENSIONS)
+        files = dict((ext, path) for ext, path in files.items() if os.path.exists(path))
+        with self.lock:
+            if '.pdf' in files:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if '.pdf' not in files:
+            return None
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def store(self, key, files):
+        """
+            Adds LilyPond's output, given as paths by extension, under key
+            and evicts least recently used entries down to max_bytes.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.' + key)
+        try:
+            for ext, path in files.items():
+                shutil.copyfile(path, os.path.join(tmp, 'score' + ext))
+            try:
+                os.rename(tmp, self.path(key))
+            except OSError:
+                # 其他进程刚存入了同一乐谱
+                shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """
+            (last use, size, path) of every entry.
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        """
+            Hits and misses of this process, in the format of
+            StageCache.stats().
+        """
+
+        with self.lock:
+            return {'hits': {self.STAGE: self.hits}, 'misses': {self.STAGE: self.misses}}
@@ -0,0 +1,102 @@
+import functools
+import math
+import wave
+import numpy as np
+from scipy.signal import firwin, resample_poly
+try:
+    import soxr
+except ImportError:
+    soxr = None
+from melody_note.work.wav_note.audio_segment import AudioSegment
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE
+
+# Polyphase resampler quality profiles: half length of the anti-aliasing
+# FIR filter in taps per unit of max(up, down), and its Kaiser window beta.
+# 'balanced' is resample_poly's own default design.
+QUALITY = {
+    'fast': (4, 5.0),
+    'balanced': (10, 5.0),
+    'high': (20, 8.6),
+}
+
+# 'soxr' is libsoxr in high quality, the resampler librosa.load and
+# librosa.resample use. It is faster than every polyphase profile, so it is
+# the default wherever it is installed (librosa depends on it); the
+# polyphase profiles are opt-in.
+SOXR_QUALITY = 'soxr'
+QUALITIES = (SOXR_QUALITY,) + tuple(QUALITY)
+DEFAULT_QUALITY = SOXR_QUALITY if soxr is not None else 'balanced'
+
+
+@functools.lru_cache(maxsize=None)
+def design_filter(src_rate, dst_rate, quality=DEFAULT_QUALITY):
+    """
+        Returns (up, down, FIR coefficients) of the polyphase resampler
+        from src_rate to dst_rate. The design is cached per rate pair and
+        quality, so every recording at the same rate reuses it.
+    """
+
+    if quality not in QUALITY:
+        raise ValueError('Unknown resampler quality: %s' % (quality,))
+    g = math.gcd(int(src_rate), int(dst_rate))
+    up, down = int(dst_rate) // g, int(src_rate) // g
+    if up == down:
+        # 采样率相同，无需滤波
+        return up, down, None
+    taps, beta = QUALITY[quality]
+    max_rate = max(up, down)
+    # 与 resample_poly 的默认设计相同：截止频率为 1 / max_rate（增益 up 由 resample_poly 乘上）
+    h = firwin(2 * taps * max_rate + 1, 1.0 / max_rate, window=('kaiser', beta))
+    h.setflags(write=False)
+    return up, down, h
+
+
+def resample(x, src_rate, dst_rate, quality=DEFAULT_QUALITY, dtype=ANALYSIS_DTYPE):
+    """
+        Resamples x (along the first axis) from src_rate to dst_rate with
+        soxr or the cached polyphase filter of the given quality profile,
+        computed and returned in dtype. Both apply an anti-aliasing
+        low-pass, so decimating this way is safe for the analysis stages.
+    """
+
+    if quality == SOXR_QUALITY and soxr is None:
+        # 没有安装 soxr 时使用多相滤波器
+        quality = 'balanced'
+    x = np.asarray(x, dtype=dtype)
+    if quality == SOXR_QUALITY:
+        if int(src_rate) == int(dst_rate):
+            return x
+        return soxr.resample(x, int(src_rate), int(dst_rate), quality='HQ')
+    up, down, h = design_filter(int(src_rate), int(dst_rate), quality)
+    if up == down:
+        return x
+    return resample_poly(x, up, down, axis=0, window=h.astype(dtype))
+
+
+def decimate(recording, analysis_rate, quality=DEFAULT_QUALITY, dtype=ANALYSIS_DTYPE):
+    """
+        The AudioSegment of a recording at analysis_rate for the
+        denoise/onset/pitch stages, held in memory as dtype samples on the
+        16-bit scale (no rounding back to int16). Recordings already at or
+        below analysis_rate are returned as they are.
+    """
+
+    framerate = min(recording.framerate, int(analysis_rate))
+    if framerate == recording.framerate:
+        return recording
+    frames = recording.buffer[recording.offset:recording.offset + recording.length]
+    return AudioSegment(resample(frames, recording.framerate, framerate, quality, dtype), framerate)
+
+
+def decimate_file(music_file, output_file, analysis_rate, quality=DEFAULT_QUALITY):
+    """
+        Writes decimate() of a 16-bit wav file to output_file as 16-bit
+        wav (a debug artifact; the pipeline keeps the decimated signal in
+        memory). Returns the frame rate of the copy.
+    """
+
+    recording = decimate(AudioSegment.from_file(music_file), analysis_rate, quality)
+    with wave.open(output_file, 'wb') as w:
+        w.setparams((recording.nchannels, 2, recording.framerate, recording.length, 'NONE', 'not compressed'))
+        w.writeframes(recording.tobytes())
+    return recording.framerate
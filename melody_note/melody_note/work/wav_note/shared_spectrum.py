@@ -0,0 +1,142 @@
+import numpy
+import librosa
+from melody_note.work.wav_note import speech_enhance
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE
+from melody_note.work.wav_note.first_peaks_method import MIN_NOTE_DURATION
+from melody_note.work.wav_note.piano_key_method import LOWEST_KEY, HIGHEST_KEY
+
+# Frequency range (Hz) of the spectral flux and of the pitch search.
+MAX_FLUX_FREQ = 5000.0
+FMIN = 60.0
+FMAX = 2000.0
+
+# The flux compares frames FLUX_LAG hops apart (20 ms, close to librosa's
+# 512-sample hop at 22050 Hz); onsets are at least ONSET_WAIT seconds apart.
+FLUX_LAG = 2
+ONSET_WAIT = 0.1
+
+# A segment is voiced if the peak of its pooled, window-corrected
+# autocorrelation reaches VOICING; the shortest lag whose peak is within
+# OCTAVE_TOLERANCE of the highest one is taken as the period.
+VOICING = 0.3
+OCTAVE_TOLERANCE = 0.85
+
+
+class SharedSpectrum(object):
+    """
+        The denoiser's spectrogram of a recording, kept in memory for the
+        onset and pitch stages: onsets come from its spectral flux and the
+        pitch of every onset segment from the pooled frames in the segment,
+        so the recording is transformed only once. The spectrogram is kept
+        in dtype (see dtypes.py).
+    """
+
+    def __init__(self, x, fs, subtract=speech_enhance.subtract_numpy, dtype=ANALYSIS_DTYPE):
+        self.fs = fs
+        self.duration = len(x) / float(fs)
+        self.len_, self.len1, self.len2, self.win, self.winGain, self.nFFT = speech_enhance.frame_params(fs)
+        self.win = self.win.astype(dtype)
+        self.signal, self.magnitude = speech_enhance.spectral_subtraction_frames(x, fs, subtract, dtype)
+        window_acf = numpy.fft.irfft(abs(numpy.fft.rfft(self.win, self.nFFT)) ** 2, self.nFFT)
+        self.window_acf = window_acf[:self.len_] / window_acf[0]
+
+    def frame_times(self):
+        """
+            Centre (s) of every frame, the instant its spectrum describes.
+        """
+
+        return (numpy.arange(len(self.magnitude)) * self.len2 + self.len_ / 2.0) / self.fs
+
+    def onset_envelope(self):
+        """
+            Spectral flux: mean rise of the log mel power up to MAX_FLUX_FREQ
+            over FLUX_LAG frames, as librosa.onset.onset_strength computes
+            it from its own mel spectrogram.
+        """
+
+        mel = librosa.feature.melspectrogram(S=(self.magnitude ** 2).T, sr=self.fs,
+                                             n_fft=self.nFFT, fmax=MAX_FLUX_FREQ).T
+        level = librosa.power_to_db(mel, ref=numpy.max)
+        flux = numpy.zeros(len(level), dtype=level.dtype)
+        flux[FLUX_LAG:] = numpy.maximum(level[FLUX_LAG:] - level[:-FLUX_LAG], 0).mean(axis=1)
+        return flux
+
+    def onsets(self):
+        """
+            Onset times (s), picked from the spectral flux with librosa's
+            peak picking. The first onset is moved to 0 and the end of the
+            recording is appended, as in OnsetFrameSplitter.
+        """
+
+        frames = librosa.onset.onset_detect(onset_envelope=self.onset_envelope(), sr=self.fs,
+                                            hop_length=self.len2, units='frames',
+                                            wait=int(ONSET_WAIT * self.fs / self.len2))
+        onsets = list(self.frame_times()[frames])
+        if not onsets:
+            onsets = [0.0]
+        onsets[0] = 0.0
+        onsets.append(self.duration)
+        return numpy.array(onsets)
+
+    def pitch_from_acf(self, acf):
+        """
+            MIDI note of a segment given the autocorrelation of its pooled
+            frames: the autocorrelation is corrected for the window's own
+            autocorrelation and its period peak picked.
+        """
+
+        if acf[0] <= 0:
+            return []
+        tau_min = int(self.fs / FMAX)
+        # Lags beyond half a frame are too poorly covered by the window.
+        tau_max = min(int(numpy.ceil(self.fs / FMIN)), self.len_ // 2)
+        nacf = acf[:tau_max + 2] / acf[0] / self.window_acf[:tau_max + 2]
+
+        lags = numpy.arange(tau_min, tau_max + 1)
+        peaks = lags[(nacf[lags] > nacf[lags - 1]) & (nacf[lags] >= nacf[lags + 1])]
+        if len(peaks) == 0 or nacf[peaks].max() < VOICING:
+            return []
+        tau = peaks[numpy.argmax(nacf[peaks] >= OCTAVE_TOLERANCE * nacf[peaks].max())]
+
+        # Parabolic interpolation around the peak.
+        left, mid, right = nacf[tau - 1], nacf[tau], nacf[tau + 1]
+        denominator = left - 2 * mid + right
+        period = tau + (0.5 * (left - right) / denominator if denominator != 0 else 0)
+        note = int(numpy.rint(69 + 12 * numpy.log2(self.fs / period / 440.0)))
+        if note < LOWEST_KEY or note > HIGHEST_KEY:
+            return []
+        return [note]
+
+    def detect_MIDI_notes(self):
+        """
+            Returns the MIDI notes of every onset segment and the segment
+            durations, as first_peaks_method.detect_MIDI_notes_batch does for
+            the split segments.
+        """
+
+        onsets = self.onsets()
+        durations = numpy.diff(onsets)
+        # Frames of segment i are rows bounds[i]:bounds[i + 1].
+        bounds = numpy.searchsorted(self.frame_times(), onsets)
+        pooled = [i for i in range(len(durations))
+                  if durations[i] > MIN_NOTE_DURATION and bounds[i + 1] > bounds[i]]
+        midi_notes = [[] for d in durations]
+        if pooled:
+            power = numpy.array([(self.magnitude[bounds[i]:bounds[i + 1]] ** 2).sum(axis=0) for i in pooled])
+            acf = numpy.fft.irfft(power, self.nFFT)[:, :self.len_]
+            for i, row in zip(pooled, acf):
+                midi_notes[i] = self.pitch_from_acf(row)
+        return midi_notes, durations
+
+
+def load_mono(music_file, dtype=ANALYSIS_DTYPE):
+    """
+        Reads a 16-bit wav file as mono dtype samples.
+    """
+
+    params, x = speech_enhance.read_wav(music_file)
+    nchannels = params[0]
+    x = x.astype(dtype)
+    if nchannels > 1:
+        x = x[:len(x) // nchannels * nchannels].reshape(-1, nchannels).mean(axis=1)
+    return params, x
@@ -1,39 +1,129 @@
 import numpy as np
 import wave
+import time
 from melody_note.work.wav_note import nextpow2
+from melody_note.work.wav_note.wav_reader import open_wav
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE, PCM_DTYPE
 import math
 
-def noise_reduction(filename, output_file):
-    # 打开WAV文档
-    f = wave.open(filename)
+try:
+    import numba
+except ImportError:     # numba 是可选依赖，缺失时使用 numpy 实现
+    numba = None
 
-    # 读取格式信息
-    # (nchannels, sampwidth, framerate, nframes, comptype, compname)
-    params = f.getparams()
-    nchannels, sampwidth, framerate, nframes = params[:4]
-    fs = framerate
-    # 读取波形数据
-    str_data = f.readframes(nframes)
-    f.close()
-    # 将波形数据转换为数组
-    x = np.fromstring(str_data, dtype=np.short)
-    # 计算参数
-    len_ = 20 * fs // 1000 # 样本中帧的大小
-    PERC = 50 # 窗口重叠占帧的百分比
+# 谱减法默认参数
+PERC = 50       # 窗口重叠占帧的百分比
+Thres = 3       # VAD 阈值（dB）
+Expnt = 2.0     # 1.0 为幅度谱，2.0 为功率谱
+beta = 0.002    # 谱下限系数
+G = 0.9         # 噪声谱平滑系数
+
+# 批处理引擎与逐帧引擎之间的误差容限：
+# 浮点输出相对于信号峰值的误差不超过 BATCH_RTOL（dtype=np.float64 时）
+# 或 FLOAT32_RTOL（默认的 float32 分析精度，见 dtypes.py），
+# 转换为 int16 后逐样本误差不超过 1 LSB（截断取整导致）。
+BATCH_RTOL = 1e-9
+FLOAT32_RTOL = 1e-5
+
+
+def berouti(SNR):
+    a = 0
+    if -5.0 <= SNR <= 20.0:
+        a = 4 - SNR * 3 / 20
+    else:
+        if SNR < -5.0:
+            a = 5
+        if SNR > 20:
+            a = 1
+    return a
+
+
+def berouti1(SNR):
+    a = 0
+    if -5.0 <= SNR <= 20.0:
+        a = 3 - SNR * 2 / 20
+    else:
+        if SNR < -5.0:
+            a = 4
+        if SNR > 20:
+            a = 1
+    return a
+
+
+def berouti_coefficients():
+    """
+        Returns (top, slope, base) of the berouti rule for the current Expnt:
+        alpha = base - SNR * slope inside [-5, 20] dB, top below, 1 above.
+    """
+
+    if Expnt == 1.0:
+        return 4, 2 / 20, 3
+    return 5, 3 / 20, 4
+
+
+def berouti_array(SNR):
+    """
+        Vectorized berouti/berouti1: over-subtraction factor for every frame.
+        NaN SNRs fall through every branch and get 0, as in the scalar version.
+    """
+
+    top, slope, base = berouti_coefficients()
+    return np.select([(SNR >= -5.0) & (SNR <= 20.0), SNR < -5.0, SNR > 20],
+                     [base - SNR * slope, top, 1], default=0)
+
+
+def frame_params(fs):
+    """
+        Returns the framing parameters used by spectral subtraction
+        for a given sampling rate.
+    """
+
+    len_ = 20 * fs // 1000  # 样本中帧的大小
+    # 50% 重叠的重叠相加要求帧长为偶数（如 22050 Hz 时为 441）
+    len_ -= len_ % 2
     len1 = len_ * PERC // 100  # 重叠窗口
     len2 = len_ - len1   # 非重叠窗口
-    # 设置默认参数
-    Thres = 3
-    Expnt = 2.0
-    beta = 0.002
-    G = 0.9
     # 初始化汉明窗
     win = np.hamming(len_)
     # normalization gain for overlap+add with 50% overlap
-    winGain = len2 / sum(win)
+    # （Python float，与输出相乘时不改变其精度）
+    winGain = float(len2 / sum(win))
+    nFFT = 2 * 2 ** (nextpow2.nextpow2(len_))
+    return len_, len1, len2, win, winGain, nFFT
+
+
+def read_wav(filename):
+    """
+        Reads a 16-bit wav file, returns its params and samples.
+        The samples are a read-only memory-mapped view of the data chunk.
+    """
+
+    # (nchannels, sampwidth, framerate, nframes, comptype, compname)
+    params, data = open_wav(filename)
+    # 交错存放的采样值，不复制
+    return params, data.reshape(-1)
+
+
+def write_wav(output_file, params, xfinal):
+    # 保存文件
+    wf = wave.open(output_file, 'wb')
+    # 设置参数
+    wf.setparams(params)
+    # 设置波形文件 .tobytes()将array转换为data
+    wave_data = xfinal.astype(PCM_DTYPE)
+    wf.writeframes(wave_data.tobytes())
+    wf.close()
+
+
+def spectral_subtraction_loop(x, fs):
+    """
+        Reference frame-by-frame spectral subtraction engine.
+        Returns the denoised signal (already scaled by the window gain).
+    """
+
+    len_, len1, len2, win, winGain, nFFT = frame_params(fs)
 
     # Noise magnitude calculations - assuming that the first 5 frames is noise/silence
-    nFFT = 2 * 2 ** (nextpow2.nextpow2(len_))
     noise_mean = np.zeros(nFFT)
 
     j = 0
@@ -62,30 +152,6 @@ def noise_reduction(filename, output_file):
         theta = np.angle(spec)
         SNRseg = 10 * np.log10(np.linalg.norm(sig, 2) ** 2 / np.linalg.norm(noise_mu, 2) ** 2)
 
-
-        def berouti(SNR):
-            a = 0
-            if -5.0 <= SNR <= 20.0:
-                a = 4 - SNR * 3 / 20
-            else:
-                if SNR < -5.0:
-                    a = 5
-                if SNR > 20:
-                    a = 1
-            return a
-
-
-        def berouti1(SNR):
-            a = 0
-            if -5.0 <= SNR <= 20.0:
-                a = 3 - SNR * 2 / 20
-            else:
-                if SNR < -5.0:
-                    a = 4
-                if SNR > 20:
-                    a = 1
-            return a
-
         if Expnt == 1.0:  # 幅度谱
             alpha = berouti1(SNRseg)
         else:  # 功率谱
@@ -122,11 +188,363 @@ def noise_reduction(filename, output_file):
         xfinal[k-1:k + len2 - 1] = x_old + xi[0:len1]
         x_old = xi[0 + len1:len_]
         k = k + len2
-    # 保存文件
-    wf = wave.open(output_file, 'wb')
-    # 设置参数
-    wf.setparams(params)
-    # 设置波形文件 .tostring()将array转换为data
-    wave_data = (winGain * xfinal).astype(np.short)
-    wf.writeframes(wave_data.tostring())
-    wf.close()
\ No newline at end of file
+    return winGain * xfinal
+
+
+def frame_signal(x, len_, len2, Nframes):
+    """
+        Returns a read-only (Nframes, len_) strided view of x whose rows
+        start every len2 samples.
+    """
+
+    frames = np.lib.stride_tricks.sliding_window_view(x, len_)
+    return frames[:Nframes * len2:len2]
+
+
+def spectrum_energy(power, nFFT):
+    """
+        Energy of the full nFFT-point spectrum given the one-sided power
+        spectrum of a real signal (interior bins are counted twice).
+    """
+
+    return 2 * power.sum(axis=-1) - power[..., 0] - power[..., nFFT // 2]
+
+
+def noise_scan(sig_e, sig_energy, noise_e, nFFT):
+    """
+        Sequential part of spectral subtraction. Walks the frames in order,
+        computing each frame's SNR against the current noise estimate and
+        re-smoothing the estimate on frames quieter than Thres.
+        Returns the noise estimate seen by every frame, the per-frame SNR
+        and the estimate after the last frame.
+    """
+
+    Nframes = len(sig_e)
+    noise_frames = np.empty_like(sig_e)
+    SNRseg = np.empty(Nframes)
+    noise_energy = spectrum_energy(noise_e ** (2 / Expnt), nFFT)
+    for n in range(Nframes):
+        noise_frames[n] = noise_e
+        SNRseg[n] = 10 * np.log10(sig_energy[n] / noise_energy)
+        if SNRseg[n] < Thres:  # Update noise spectrum
+            noise_e = G * noise_e + (1 - G) * sig_e[n]
+            noise_energy = spectrum_energy(noise_e ** (2 / Expnt), nFFT)
+    return noise_frames, SNRseg, noise_e
+
+
+def subtract_numpy(sig_e, sig_energy, noise_e, nFFT):
+    """
+        Noise subtraction for the whole frame matrix: sequential noise scan,
+        then over-subtraction and floor clamp as array ops.
+        Returns the subtracted spectrum and the updated noise estimate.
+    """
+
+    noise_frames, SNRseg, noise_e = noise_scan(sig_e, sig_energy, noise_e, nFFT)
+    # SNR 为 float64，alpha 转回谱的精度，避免整个矩阵被提升为 float64
+    alpha = berouti_array(SNRseg).astype(sig_e.dtype)
+    sub_speech = sig_e - alpha[:, np.newaxis] * noise_frames
+    floor = beta * noise_frames
+    return np.where(sub_speech - floor < 0, floor, sub_speech), noise_e
+
+
+def _subtract_kernel(sig_e, sig_energy, noise_e, nFFT, Thres, Expnt, beta, G, top, slope, base):
+    """
+        Scalar-loop version of subtract_numpy, compiled with numba.
+        Fuses the per-frame SNR, the berouti alpha choice, the floor clamp
+        and the VAD-gated noise update into one pass over the frames.
+    """
+
+    Nframes, nbins = sig_e.shape
+    sub_speech = np.empty_like(sig_e)
+    noise_e = noise_e.copy()
+    noise_energy = 0.0
+    for b in range(nbins):
+        noise_energy += noise_e[b] ** (2 / Expnt)
+    noise_energy = 2 * noise_energy - noise_e[0] ** (2 / Expnt) - noise_e[nFFT // 2] ** (2 / Expnt)
+    for n in range(Nframes):
+        SNRseg = 10 * np.log10(sig_energy[n] / noise_energy)
+        alpha = 0.0
+        if -5.0 <= SNRseg <= 20.0:
+            alpha = base - SNRseg * slope
+        elif SNRseg < -5.0:
+            alpha = top
+        elif SNRseg > 20:
+            alpha = 1.0
+        for b in range(nbins):
+            floor = beta * noise_e[b]
+            value = sig_e[n, b] - alpha * noise_e[b]
+            if value - floor < 0:
+                value = floor
+            sub_speech[n, b] = value
+        if SNRseg < Thres:  # Update noise spectrum
+            noise_energy = 0.0
+            for b in range(nbins):
+                noise_e[b] = G * noise_e[b] + (1 - G) * sig_e[n, b]
+                noise_energy += noise_e[b] ** (2 / Expnt)
+            noise_energy = 2 * noise_energy - noise_e[0] ** (2 / Expnt) - noise_e[nFFT // 2] ** (2 / Expnt)
+    return sub_speech, noise_e
+
+
+if numba is not None:
+    # error_model='numpy'：除零得到 inf/nan，与 numpy 实现一致
+    _subtract_kernel = numba.njit(error_model='numpy')(_subtract_kernel)
+
+
+def subtract_jit(sig_e, sig_energy, noise_e, nFFT):
+    """
+        Compiled counterpart of subtract_numpy. Falls back to subtract_numpy
+        when numba is not installed.
+    """
+
+    if numba is None:
+        return subtract_numpy(sig_e, sig_energy, noise_e, nFFT)
+    top, slope, base = berouti_coefficients()
+    return _subtract_kernel(sig_e, sig_energy, noise_e, nFFT,
+                            float(Thres), float(Expnt), float(beta), float(G),
+                            float(top), float(slope), float(base))
+
+
+def warm_up_jit(dtype=ANALYSIS_DTYPE):
+    """
+        Compiles the numba kernel for dtype spectra on a tiny input so the
+        first real request does not pay for it. Returns the compile/warm-up
+        time in seconds (0 when numba is not installed).
+    """
+
+    if numba is None:
+        return 0.0
+    start = time.perf_counter()
+    sig_e = np.ones((2, 5), dtype=dtype)
+    subtract_jit(sig_e, np.ones(2, dtype=dtype), np.ones(5, dtype=dtype), 8)
+    return time.perf_counter() - start
+
+
+def initial_noise(x, win, nFFT):
+    """
+        Noise magnitude calculations - assuming that the first 5 frames is
+        noise/silence. Returns the initial noise estimate raised to Expnt.
+    """
+
+    len_ = len(win)
+    noise_mu = abs(np.fft.rfft(win * frame_signal(x, len_, len_, 5), nFFT)).mean(axis=0)
+    return noise_mu ** Expnt
+
+
+def denoise_frames(frames, win, nFFT, noise_e, subtract, keep_magnitude=False):
+    """
+        Spectral subtraction of a (Nframes, len_) frame matrix given the
+        noise estimate before its first frame. Returns the time-domain
+        frames (before overlap-add) and the noise estimate after the last.
+        With keep_magnitude the denoised magnitude spectrogram
+        (Nframes, nFFT // 2 + 1) is returned as well.
+    """
+
+    spec = np.fft.rfft(win * frames, nFFT)
+    sig = abs(spec)
+    sig_energy = spectrum_energy(sig ** 2, nFFT)
+    sig_e = sig ** Expnt
+
+    sub_speech, noise_e = subtract(sig_e, sig_energy, noise_e, nFFT)
+
+    # 使用含噪信号的相位重建
+    magnitude = sub_speech ** (1 / Expnt)
+    xi = np.fft.irfft(magnitude * np.exp(1j * np.angle(spec)), nFFT)
+    if keep_magnitude:
+        return xi, noise_e, magnitude
+    return xi, noise_e
+
+
+def overlap_add(xi, len1, x_old):
+    """
+        Overlap-adds time-domain frames in one pass; x_old is the tail of
+        the frame preceding xi[0].
+    """
+
+    xfinal = xi[:, :len1].copy()
+    xfinal[0] += x_old
+    xfinal[1:] += xi[:-1, len1:]
+    return xfinal.ravel()
+
+
+def spectral_subtraction_batch(x, fs, subtract=subtract_numpy, dtype=ANALYSIS_DTYPE):
+    """
+        Whole-signal spectral subtraction engine. Frames the signal with a
+        strided view, transforms all frames with one rfft call, applies the
+        over-subtraction and floor rules to the whole frame matrix and
+        overlap-adds the result in a single pass. Computes in dtype and
+        matches spectral_subtraction_loop within BATCH_RTOL for np.float64
+        and within FLOAT32_RTOL for np.float32.
+        `subtract` performs the sequential noise subtraction on the
+        magnitude matrix (subtract_numpy or subtract_jit).
+    """
+
+    return spectral_subtraction_frames(x, fs, subtract, dtype)[0]
+
+
+def spectral_subtraction_frames(x, fs, subtract=subtract_numpy, dtype=ANALYSIS_DTYPE):
+    """
+        spectral_subtraction_batch that also returns the denoised magnitude
+        spectrogram, so later stages can reuse the denoiser's transform.
+        Row n is the Hamming-windowed nFFT-point spectrum of the frame
+        starting at n * len2 (see frame_params).
+    """
+
+    len_, len1, len2, win, winGain, nFFT = frame_params(fs)
+    x = np.asarray(x, dtype=dtype)
+    win = win.astype(dtype)
+    Nframes = len(x) // len2 - 1
+    xi, noise_e, magnitude = denoise_frames(frame_signal(x, len_, len2, Nframes), win, nFFT,
+                                            initial_noise(x, win, nFFT), subtract, keep_magnitude=True)
+    # --- Overlap and add ---------------
+    return winGain * overlap_add(xi[:, :len_], len1, np.zeros(len_ - len1, dtype=dtype)), magnitude
+
+
+class StreamingDenoiser(object):
+    """
+        Block-by-block spectral subtraction. Between blocks only the samples
+        of the next incomplete frame, the overlap tail of the last frame and
+        the running noise estimate are kept, so memory does not grow with
+        the recording length. The concatenated output is identical to
+        spectral_subtraction_batch on the whole signal.
+    """
+
+    def __init__(self, fs, subtract=subtract_numpy, dtype=ANALYSIS_DTYPE):
+        self.len_, self.len1, self.len2, self.win, self.winGain, self.nFFT = frame_params(fs)
+        self.subtract = subtract
+        self.dtype = dtype
+        self.win = self.win.astype(dtype)
+        self.pending = np.zeros(0, dtype=dtype)
+        self.noise_e = None
+        self.x_old = np.zeros(self.len_ - self.len1, dtype=dtype)
+
+    def process(self, block):
+        """
+            Feeds a block of PCM samples, returns the denoised samples that
+            became final (possibly none).
+        """
+
+        self.pending = np.concatenate((self.pending, np.asarray(block, dtype=self.dtype)))
+        # 前 5 帧用于噪声估计，攒够之前不输出
+        if self.noise_e is None and len(self.pending) < 5 * self.len_:
+            return np.zeros(0, dtype=self.dtype)
+        return self._run()
+
+    def flush(self):
+        """
+            Ends the stream, returns whatever the last blocks still produce.
+        """
+
+        return self._run()
+
+    def _run(self):
+        if len(self.pending) < self.len_:
+            return np.zeros(0, dtype=self.dtype)
+        if self.noise_e is None:
+            self.noise_e = initial_noise(self.pending, self.win, self.nFFT)
+        Nframes = (len(self.pending) - self.len_) // self.len2 + 1
+        frames = frame_signal(self.pending, self.len_, self.len2, Nframes)
+        xi, self.noise_e = denoise_frames(frames, self.win, self.nFFT, self.noise_e, self.subtract)
+        xi = xi[:, :self.len_]
+        xfinal = overlap_add(xi, self.len1, self.x_old)
+        self.x_old = xi[-1, self.len1:]
+        self.pending = self.pending[Nframes * self.len2:]
+        return self.winGain * xfinal
+
+
+def noise_reduction_stream(blocks, fs, subtract=subtract_numpy, dtype=ANALYSIS_DTYPE):
+    """
+        Generator version of spectral subtraction: takes an iterable of PCM
+        blocks and yields denoised blocks as soon as they are final.
+    """
+
+    denoiser = StreamingDenoiser(fs, subtract, dtype)
+    for block in blocks:
+        out = denoiser.process(block)
+        if len(out) > 0:
+            yield out
+    out = denoiser.flush()
+    if len(out) > 0:
+        yield out
+
+
+def read_wav_blocks(data, block_frames):
+    """
+        Yields the interleaved samples of a memory-mapped (nframes,
+        nchannels) wav data chunk block_frames frames at a time.
+    """
+
+    for start in range(0, len(data), block_frames):
+        yield data[start:start + block_frames].reshape(-1)
+
+
+def spectral_subtraction_jit(x, fs, dtype=ANALYSIS_DTYPE):
+    """
+        Batched engine with the sequential noise subtraction compiled by
+        numba; identical to spectral_subtraction_batch without numba.
+    """
+
+    return spectral_subtraction_batch(x, fs, subtract_jit, dtype)
+
+
+# 'loop' 为 float64 参考实现，'batch' 与 'jit' 按 dtypes.ANALYSIS_DTYPE 计算
+ENGINES = {
+    'loop': spectral_subtraction_loop,
+    'batch': spectral_subtraction_batch,
+    'jit': spectral_subtraction_jit,
+}
+
+
+# 流式处理可用的噪声相减实现
+STREAM_SUBTRACT = {
+    'batch': subtract_numpy,
+    'jit': subtract_jit,
+}
+
+
+def denoise(filename, engine='batch', dtype=ANALYSIS_DTYPE):
+    """
+        Denoises a 16-bit wav file in memory. Returns its params and the
+        int16 samples noise_reduction would write to the output file.
+    """
+
+    params, x = read_wav(filename)
+    return params, denoise_samples(x, params[2], engine, dtype)
+
+
+def denoise_samples(x, fs, engine='batch', dtype=ANALYSIS_DTYPE):
+    """
+        Denoises int16 samples (or float samples on the same scale) already
+        in memory, returns int16 samples.
+        dtype is the precision of the batched engines ('loop' always
+        computes in float64).
+    """
+
+    if engine not in ENGINES:
+        raise ValueError('Unknown noise reduction engine: %s' % (engine,))
+    if engine == 'loop':
+        return spectral_subtraction_loop(x, fs).astype(PCM_DTYPE)
+    return ENGINES[engine](x, fs, dtype=dtype).astype(PCM_DTYPE)
+
+
+def noise_reduction(filename, output_file, engine='batch', block_frames=None):
+    """
+        Denoises a 16-bit wav file into output_file. With block_frames set
+        the file is read, denoised and written block by block, keeping peak
+        memory constant regardless of the recording length.
+    """
+
+    if engine not in ENGINES:
+        raise ValueError('Unknown noise reduction engine: %s' % (engine,))
+    if block_frames is not None:
+        if engine not in STREAM_SUBTRACT:
+            raise ValueError('Engine %s does not support streaming' % (engine,))
+        params, data = open_wav(filename)
+        wf = wave.open(output_file, 'wb')
+        wf.setparams(params)
+        for out in noise_reduction_stream(read_wav_blocks(data, block_frames), params[2],
+                                          STREAM_SUBTRACT[engine]):
+            wf.writeframes(out.astype(PCM_DTYPE).tobytes())
+        wf.close()
+        return
+    params, wave_data = denoise(filename, engine)
+    write_wav(output_file, params, wave_data)
@@ -0,0 +1,164 @@
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+WAV_NOTE_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGE_CACHE_DIR = os.path.join(os.path.dirname(WAV_NOTE_DIR), 'stage_cache')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# 改变某一阶段的算法（结果会不同）时加一，旧的缓存项随之失效
+CACHE_VERSION = 2
+
+# get() 未命中时的返回值（None 也可能是缓存的结果）
+MISSING = object()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+        SHA-256 of the contents of a file, the root of the stage keys of a
+        recording.
+    """
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stage_key(parent, stage, *params):
+    """
+        The key of a stage's result: a digest of the key of its input (the
+        audio digest or the previous stage's key), the stage name and the
+        parameters the result depends on. Equal keys mean equal results.
+    """
+
+    return hashlib.sha256(repr((CACHE_VERSION, parent, stage, params)).encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """
+        Content-addressed cache of the results of the transcription stages
+        (denoised signal, onsets, detections, score) on local disk. Entries
+        are pickles named after their key; reading an entry touches it and
+        the least recently used entries are removed once the cache holds
+        more than max_bytes. Several processes may share the directory.
+
+        cache = StageCache()
+        onsets = cache.fetch('onsets', key, lambda: detect_onsets(...))
+    """
+
+    # MusicTranscriber 使用的阶段
+    STAGES = ('denoise', 'onsets', 'detect', 'score')
+
+    def __init__(self, directory=STAGE_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # 本进程中各阶段的命中与未命中次数
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, stage, key):
+        """
+            The cached result of stage with the given key, MISSING if there
+            is none.
+        """
+
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            value = MISSING
+        except Exception as e:
+            # 写坏或版本不兼容的缓存项当作未命中，之后被覆盖
+            print ('Ignoring stage cache entry %s: %s' % (path, e))
+            value = MISSING
+        else:
+            # 更新最近使用时间，evict 按它淘汰；读完后可能刚被其他进程淘汰
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            if value is MISSING:
+                self.misses[stage] += 1
+            else:
+                self.hits[stage] += 1
+        return value
+
+    def put(self, key, value):
+        """
+            Stores a result, then evicts least recently used entries down to
+            max_bytes. The entry is written under a temporary name and
+            renamed, so other processes never read a partial pickle.
+        """
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + key)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def fetch(self, stage, key, compute):
+        """
+            The cached result of stage with the given key; on a miss
+            compute() is called and its result stored.
+        """
+
+        value = self.get(stage, key)
+        if value is MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def entries(self):
+        """
+            (last use, size, path) of every entry.
+        """
+
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.pkl'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        """
+            Hit and miss counts of this process by stage.
+        """
+
+        with self.lock:
+            return {'hits': dict(self.hits), 'misses': dict(self.misses)}
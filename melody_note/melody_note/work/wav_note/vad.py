@@ -0,0 +1,127 @@
+import numpy as np
+from melody_note.work.wav_note.audio_segment import AudioSegment
+from melody_note.work.wav_note.first_peaks_method import MIN_NOTE_DURATION
+
+# Energy frames of VAD_FRAME seconds every VAD_HOP seconds.
+VAD_FRAME = 0.02
+VAD_HOP = 0.01
+
+# A frame is voiced if its level is VAD_MARGIN_DB above the noise floor
+# (10th percentile of the frame levels) and at most VAD_RANGE_DB below the
+# loudest frame. Frames within VAD_HEADROOM_DB of the loudest frame are
+# always voiced (recordings with hardly any silence have no usable floor).
+VAD_MARGIN_DB = 15.0
+VAD_RANGE_DB = 45.0
+VAD_HEADROOM_DB = 25.0
+
+# Voiced regions are padded by VAD_PAD seconds on both sides, gaps shorter
+# than VAD_MIN_GAP seconds are bridged and regions shorter than a note are
+# dropped.
+VAD_PAD = 0.1
+VAD_MIN_GAP = 0.3
+
+# Silence kept in front of the trimmed signal for the denoiser's noise
+# estimate (its first 5 frames of 20 ms).
+NOISE_LEAD_IN = 0.1
+
+
+def frame_levels(recording):
+    """
+        Level (dB) of every VAD frame of an AudioSegment, computed in one
+        pass from the cumulative energy of the channel mean.
+    """
+
+    x = recording.samples.astype(np.float64)
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    frame = int(VAD_FRAME * recording.framerate)
+    hop = int(VAD_HOP * recording.framerate)
+    energy = np.concatenate(([0.0], np.cumsum(x ** 2)))
+    starts = np.arange(0, max(len(x) - frame, 0) + 1, hop)
+    stops = np.minimum(starts + frame, len(x))
+    return 10 * np.log10((energy[stops] - energy[starts]) / np.maximum(stops - starts, 1) + 1e-10), hop
+
+
+def voiced_spans(recording):
+    """
+        Returns the voiced regions of an AudioSegment as an (n, 2) array of
+        [start, stop) frame offsets into it.
+    """
+
+    levels, hop = frame_levels(recording)
+    peak = levels.max()
+    threshold = min(max(np.percentile(levels, 10) + VAD_MARGIN_DB, peak - VAD_RANGE_DB), peak - VAD_HEADROOM_DB)
+    voiced = np.concatenate(([False], levels > threshold, [False]))
+    edges = np.flatnonzero(voiced[1:] != voiced[:-1])
+    spans = edges.reshape(-1, 2) * hop
+    spans[:, 1] += int(VAD_FRAME * recording.framerate) - hop
+
+    pad = int(VAD_PAD * recording.framerate)
+    spans[:, 0] = np.maximum(spans[:, 0] - pad, 0)
+    spans[:, 1] = np.minimum(spans[:, 1] + pad, recording.length)
+    if len(spans) > 1:
+        # Bridge short gaps.
+        keep = np.concatenate(([True], spans[1:, 0] - spans[:-1, 1] >= VAD_MIN_GAP * recording.framerate))
+        group = np.cumsum(keep) - 1
+        merged = np.empty((group[-1] + 1, 2), dtype=spans.dtype)
+        merged[:, 0] = spans[keep, 0]
+        merged[:, 1] = np.maximum.reduceat(spans[:, 1], np.flatnonzero(keep))
+        spans = merged
+    return spans[spans[:, 1] - spans[:, 0] > MIN_NOTE_DURATION * recording.framerate]
+
+
+class TrimmedRecording(object):
+    """
+        The voiced spans of a recording joined into one AudioSegment, after
+        a short noise lead-in for the denoiser, and the mapping of its
+        frame offsets back to the original recording.
+    """
+
+    def __init__(self, recording, spans):
+        self.recording = recording
+        self.spans = spans
+        lead_in = int(NOISE_LEAD_IN * recording.framerate)
+        pieces = list(spans)
+        if len(spans) > 0 and spans[0][0] >= lead_in:
+            pieces.insert(0, (0, lead_in))
+        else:
+            lead_in = 0
+        self.lead_in = lead_in
+        self.pieces = np.array(pieces, dtype=np.int64).reshape(-1, 2)
+        lengths = self.pieces[:, 1] - self.pieces[:, 0]
+        # Offset of every piece in the trimmed signal.
+        self.trimmed_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        start = recording.offset
+        buffer = recording.buffer[:0]
+        if len(self.pieces) > 0:
+            buffer = np.concatenate([recording.buffer[start + a:start + b] for a, b in self.pieces])
+        self.trimmed = AudioSegment(buffer, recording.framerate)
+
+    def to_original(self, frames):
+        """
+            Maps frame offsets of the trimmed signal to the recording.
+        """
+
+        frames = np.asarray(frames, dtype=np.int64)
+        piece = np.searchsorted(self.trimmed_starts, frames, side='right') - 1
+        return self.pieces[piece, 0] + frames - self.trimmed_starts[piece]
+
+    def split(self, onset_times):
+        """
+            Splits the voiced spans of the recording at onsets found in the
+            trimmed signal (seconds). Every span starts a segment, like the
+            recording start does in OnsetFrameSplitter, and no segment runs
+            past the end of its span, so silences are never analysed.
+        """
+
+        onsets = np.rint(np.asarray(onset_times) * self.recording.framerate).astype(np.int64)
+        onsets = self.to_original(onsets[(onsets >= self.lead_in) & (onsets < len(self.trimmed.buffer))])
+        segments = []
+        for start, stop in self.spans:
+            inside = onsets[(onsets > start) & (onsets < stop)]
+            # An onset just after the span start is the span's own attack.
+            inside = inside[inside - start >= MIN_NOTE_DURATION * self.recording.framerate]
+            bounds = np.concatenate(([start], inside, [stop]))
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                segments.append(self.recording.slice(int(a), int(b - a)))
+        return segments
@@ -0,0 +1,67 @@
+import collections
+import os
+import struct
+import numpy as np
+
+# Same fields as wave.Wave_read.getparams(), so the result can be passed to
+# Wave_write.setparams.
+WavParams = collections.namedtuple('WavParams', 'nchannels sampwidth framerate nframes comptype compname')
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def read_header(f):
+    """
+        Parses the RIFF header of an open wav file. Returns the params and
+        the byte offset and size of the data chunk.
+    """
+
+    riff, size, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('No data chunk')
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', f.read(16))
+            f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError('data chunk before fmt chunk')
+            offset = f.tell()
+            break
+        else:
+            # 跳过其它块（LIST 等），块长度为奇数时有一个填充字节
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    audio_format, nchannels, framerate, byte_rate, block_align, bits = fmt
+    if audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+        raise ValueError('Unsupported wav format: %#x' % (audio_format,))
+    # Recorders that never finalised the header leave a wrong data size.
+    f.seek(0, os.SEEK_END)
+    data_size = min(chunk_size, f.tell() - offset)
+    params = WavParams(nchannels, bits // 8, framerate, data_size // block_align, 'NONE', 'not compressed')
+    return params, offset, data_size
+
+
+def open_wav(wav_file):
+    """
+        Returns the params of a 16-bit wav file and its PCM data as a
+        read-only np.memmap of shape (nframes, nchannels). Slices of it are
+        views into the page cache: nothing is copied until a stage converts
+        the samples it actually uses.
+    """
+
+    with open(wav_file, 'rb') as f:
+        params, offset, data_size = read_header(f)
+    if params.sampwidth != 2:
+        raise ValueError('Only 16-bit wav files are supported: %s' % (wav_file,))
+    if params.nframes == 0:
+        return params, np.zeros((0, params.nchannels), dtype='<i2')
+    data = np.memmap(wav_file, dtype='<i2', mode='r', offset=offset,
+                     shape=(params.nframes, params.nchannels))
+    return params, data
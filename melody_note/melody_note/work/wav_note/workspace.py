@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+
+def umask_file_mode():
+    # umask 只能在设置时读出；导入时读一次，之后不再改动进程的 umask
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# 发布的文件的权限，与 open() 新建的文件相同（mkstemp 创建的文件为 0600）
+FILE_MODE = umask_file_mode()
+
+
+class JobWorkspace(object):
+    """
+        A private scratch directory for one transcription job. Intermediate
+        files (.ly, LilyPond output, debug frames) live here, so concurrent
+        jobs never see each other's files. The directory and everything in
+        it is removed when the job ends, also on errors.
+
+        with JobWorkspace() as workspace:
+            ...
+            workspace.publish('test.pdf', final_path)
+    """
+
+    def __init__(self, prefix='melody_note_'):
+        self.prefix = prefix
+        self.path = None
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix=self.prefix)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+
+    def file(self, name):
+        """
+            Returns the path of a file inside the workspace.
+        """
+
+        return os.path.join(self.path, name)
+
+    def publish(self, name, destination):
+        """
+            Copies a workspace file to its final destination. The copy is
+            written under a temporary name and renamed, so readers never see
+            a partially written artifact. The published file gets the
+            permissions of a newly created file (FILE_MODE), not the
+            owner-only ones of the temporary file.
+        """
+
+        directory = os.path.dirname(os.path.abspath(destination))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(destination))
+        os.close(fd)
+        try:
+            shutil.copyfile(self.file(name), tmp)
+            os.chmod(tmp, FILE_MODE)
+            os.replace(tmp, destination)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return destination
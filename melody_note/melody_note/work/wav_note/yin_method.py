@@ -0,0 +1,176 @@
+import numpy
+from scipy.signal import medfilt
+from melody_note.work.wav_note.piano_key_method import LOWEST_KEY, HIGHEST_KEY
+from melody_note.work.wav_note.dtypes import ANALYSIS_DTYPE
+
+# Analysis frame and hop at the onset sample rate (22050 Hz): ~46 ms / ~12 ms.
+FRAME_LENGTH = 1024
+HOP_LENGTH = 256
+
+# Search range of the fundamental (Hz).
+FMIN = 60.0
+FMAX = 2000.0
+
+# A frame is voiced if its cumulative mean normalized difference dips below
+# YIN_THRESHOLD and it is at most SILENCE_DB below the loudest frame.
+YIN_THRESHOLD = 0.15
+SILENCE_DB = 35.0
+
+# Median filter length (frames) applied to the MIDI contour, and the
+# shortest run of frames that counts as a note.
+MEDIAN_FRAMES = 5
+MIN_NOTE_SECONDS = 0.1
+
+# A rise of the frame energy by ONSET_RISE_DB within two hops starts a new
+# note, so repeated notes of the same pitch are kept apart.
+ONSET_RISE_DB = 6.0
+
+
+def yin_f0(y, sr, max_batch_bytes=2 ** 26, dtype=ANALYSIS_DTYPE):
+    """
+        Frame-level YIN f0 tracker. Returns the f0 (Hz) of every frame
+        (0 for unvoiced frames) and its mean square energy; frame i starts
+        at i * HOP_LENGTH samples. The difference function of all frames
+        is computed at once from an FFT autocorrelation in dtype, in
+        batches of at most max_batch_bytes.
+    """
+
+    y = numpy.asarray(y, dtype=dtype)
+    tau_min = int(sr / FMAX)
+    tau_max = int(numpy.ceil(sr / FMIN))
+    span = FRAME_LENGTH + tau_max
+    nframes = max(1, 1 + (len(y) - FRAME_LENGTH) // HOP_LENGTH)
+    padded = numpy.zeros((nframes - 1) * HOP_LENGTH + span, dtype=dtype)
+    padded[:min(len(y), len(padded))] = y[:len(padded)]
+    frames = numpy.lib.stride_tricks.sliding_window_view(padded, span)[::HOP_LENGTH]
+
+    fft_length = 1
+    while fft_length < span + FRAME_LENGTH:
+        fft_length *= 2
+    lags = numpy.arange(1, tau_max + 1, dtype=dtype)
+    f0 = numpy.zeros(nframes)
+    energy = numpy.zeros(nframes)
+    # Two complex spectra of fft_length // 2 + 1 bins per row.
+    rows = max(1, max_batch_bytes // (2 * numpy.dtype(dtype).itemsize * fft_length))
+    for start in range(0, nframes, rows):
+        batch = frames[start:start + rows]
+        # r(tau) = sum_j x[j] x[j + tau] over the first FRAME_LENGTH samples.
+        head = numpy.fft.rfft(batch[:, :FRAME_LENGTH], fft_length)
+        r = numpy.fft.irfft(numpy.conj(head) * numpy.fft.rfft(batch, fft_length), fft_length)[:, :tau_max + 1]
+        squares = numpy.concatenate((numpy.zeros((len(batch), 1), dtype=dtype), numpy.cumsum(batch ** 2, axis=1)), axis=1)
+        # Energy of the window shifted by tau.
+        shifted = squares[:, FRAME_LENGTH:FRAME_LENGTH + tau_max + 1] - squares[:, :tau_max + 1]
+        diff = squares[:, FRAME_LENGTH:FRAME_LENGTH + 1] + shifted - 2 * r
+        diff = numpy.maximum(diff[:, 1:], 0)
+
+        # Cumulative mean normalized difference d'(tau), tau = 1 .. tau_max.
+        cmnd = diff * lags / numpy.maximum(numpy.cumsum(diff, axis=1), 1e-12)
+        cmnd[:, :tau_min - 1] = 1
+        # First tau below the threshold that is a local minimum.
+        below = cmnd[:, :-1] < YIN_THRESHOLD
+        rising = cmnd[:, 1:] >= cmnd[:, :-1]
+        candidates = below & rising
+        found = candidates.any(axis=1)
+        tau = candidates.argmax(axis=1)
+
+        # Parabolic interpolation around the minimum.
+        i = numpy.arange(len(batch))
+        t = numpy.clip(tau, 1, tau_max - 2)
+        left, mid, right = cmnd[i, t - 1], cmnd[i, t], cmnd[i, t + 1]
+        denominator = left - 2 * mid + right
+        shift = numpy.where(numpy.abs(denominator) > 1e-12,
+                            0.5 * (left - right) / numpy.where(denominator == 0, 1, denominator), 0)
+        period = t + 1 + numpy.clip(shift, -1, 1)
+        f0[start:start + rows] = numpy.where(found, sr / period, 0)
+        energy[start:start + rows] = squares[:, FRAME_LENGTH] / FRAME_LENGTH
+
+    loud = energy > energy.max() * 10 ** (-SILENCE_DB / 10)
+    f0[~loud] = 0
+    return f0, energy
+
+
+def f0_to_midi(f0):
+    """
+        Rounds every voiced f0 to the nearest piano key (0 when unvoiced or
+        off the keyboard).
+    """
+
+    midi = numpy.zeros(len(f0), dtype=int)
+    voiced = f0 > 0
+    midi[voiced] = numpy.rint(69 + 12 * numpy.log2(f0[voiced] / 440.0))
+    midi[(midi < LOWEST_KEY) | (midi > HIGHEST_KEY)] = 0
+    return midi
+
+
+def energy_onsets(energy):
+    """
+        Marks the frames where the energy rises by more than ONSET_RISE_DB
+        within two hops (only the frame of the steepest rise of each attack).
+    """
+
+    level = 10 * numpy.log10(numpy.maximum(energy, 1e-12))
+    rise = numpy.zeros(len(level))
+    rise[2:] = level[2:] - numpy.minimum(level[1:-1], level[:-2])
+    peak = numpy.ones(len(level), dtype=bool)
+    peak[:-1] = rise[:-1] >= rise[1:]
+    peak[1:] &= rise[1:] > rise[:-1]
+    return (rise > ONSET_RISE_DB) & peak
+
+
+def contour_to_notes(f0, energy, sr, duration):
+    """
+        Segments an f0 contour into notes. A note ends where the rounded
+        pitch changes, the signal turns unvoiced or a new attack starts.
+        Returns the MIDI number of every note and its duration in seconds,
+        measured like the onset segments of the split-based pipeline: from
+        the note's start to the next note's start (from the start of the
+        recording for the first note, to its end for the last one).
+    """
+
+    midi = f0_to_midi(f0)
+    if len(midi) >= MEDIAN_FRAMES:
+        midi = medfilt(midi, MEDIAN_FRAMES).astype(int)
+    min_frames = max(1, int(round(MIN_NOTE_SECONDS * sr / HOP_LENGTH)))
+
+    attacks = energy_onsets(energy)
+    pitch_change = numpy.ones(len(midi), dtype=bool)
+    pitch_change[1:] = midi[1:] != midi[:-1]
+    starts = list(numpy.flatnonzero(pitch_change | attacks))
+    # Short voiced runs (glides, octave slips) are merged into a neighbour:
+    # into the next run if they open an attack that then settles on its
+    # pitch, into the previous run otherwise.
+    i = 0
+    while i < len(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(midi)
+        if midi[starts[i]] and end - starts[i] < min_frames:
+            if attacks[starts[i]] and i + 1 < len(starts) and not attacks[end]:
+                midi[starts[i]:end] = midi[end]
+                del starts[i + 1]
+                continue
+            if i > 0:
+                midi[starts[i]:end] = midi[starts[i - 1]]
+                del starts[i]
+                continue
+        i += 1
+
+    starts = numpy.array(starts, dtype=int)
+    lengths = numpy.diff(numpy.append(starts, len(midi)))
+    values = midi[starts]
+    keep = (values > 0) & (lengths >= min_frames)
+    onsets = starts[keep] * HOP_LENGTH / float(sr)
+    # As in OnsetFrameSplitter, the first note starts with the recording.
+    onsets[:1] = 0.0
+    notes = [int(n) for n in values[keep]]
+    durations = numpy.diff(numpy.append(onsets, duration))
+    return notes, durations
+
+
+def detect_notes(y, sr, dtype=ANALYSIS_DTYPE):
+    """
+        Transcribes a monophonic signal in one pass: YIN f0 tracking over
+        all frames followed by note segmentation. Returns the MIDI notes
+        and their durations in seconds.
+    """
+
+    f0, energy = yin_f0(y, sr, dtype=dtype)
+    return contour_to_notes(f0, energy, sr, len(y) / float(sr))